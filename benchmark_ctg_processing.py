@@ -0,0 +1,104 @@
+# coding: utf-8
+#
+#  Copyright Douglas Williams, 2017
+#  All Rights Reserved
+#
+#  Benchmarks for ctg_processing against CTU-UHB recordings.  Each benchmark also confirms
+#  that the optimized implementation matches the original.
+#
+#  Usage:  python benchmark_ctg_processing.py [path to ctu-uhb-ctgdb] [max recordings]
+#
+
+import sys
+import time
+import numpy as np
+
+import ctg_processing
+from ctg_record import getPhysionetRecord
+from libPhysionet import getAllRecordingNumbers, BASE_ctu_uhb_ctgdb
+
+
+def referenceMaskBadFHR(rawFHR, pctLow=0.65, pctHigh=1.75, samplesPerSecond=4):
+    """Original maskBadFHR, copied verbatim.  Raises UnboundLocalError when exactly one of
+       the first two samples is invalid, so such recordings are skipped by benchmarkMaskBadFHR"""
+    # Compute Mask, applying black-out to neighboring points
+    inputMask = rawFHR > 0
+    if sum(inputMask) == 0:
+        return inputMask   # no valid data
+
+    outputMask = np.copy(inputMask)
+
+    if not inputMask[0] or not inputMask[1]:
+        # use first minute as reference:
+        segLen = 60 * samplesPerSecond   # 60 seconds @ 4 samplesPerSecond
+        i = 0
+        while sum(inputMask[i:i+segLen]) == 0:
+            if i < len(inputMask) - segLen:
+                i += segLen
+                print 'maskBadFHR skipping to next minute', i
+            else:
+                print 'maskBadFHR -- no valid data'
+                return inputMask
+        seg = rawFHR[i:i+segLen][inputMask[i:i+segLen]]
+
+        medVal = np.median(seg)  # use median as starting point
+        if not inputMask[0]:
+            first = medVal
+        if not inputMask[1]:
+            second = medVal
+    else:
+        first = rawFHR[0]
+        second = rawFHR[1]
+
+    for i in range(2, len(rawFHR)):
+        if not inputMask[i]:
+            continue
+        thresh = (first + second) / 2.0
+        if rawFHR[i] < pctLow * thresh or rawFHR[i] > pctHigh * thresh:
+            outputMask[i:min(i + 3, len(outputMask))] = 0
+        else:
+            first = second
+            second = rawFHR[i]
+
+    return outputMask
+
+
+def timeCall(func, *args, **kwargs):
+    tStart = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - tStart
+
+
+def benchmarkMaskBadFHR(allRecno, recordPrefix=BASE_ctu_uhb_ctgdb):
+    totalRef = 0.0
+    totalNew = 0.0
+    skipped = []
+    for recno in allRecno:
+        rawFHR = np.asarray(getPhysionetRecord(recno, recordPrefix).rawFHR)
+        ctg_processing.maskBadFHR(rawFHR[:1000])   # exclude any numba compilation from timing
+
+        try:
+            refMask, tRef = timeCall(referenceMaskBadFHR, rawFHR)
+        except UnboundLocalError:
+            skipped.append(recno)    # not handled by original implementation
+            continue
+        newMask, tNew = timeCall(ctg_processing.maskBadFHR, rawFHR)
+        if not np.array_equal(refMask, newMask):
+            raise Exception('maskBadFHR mismatch for recording {}'.format(recno))
+        totalRef += tRef
+        totalNew += tNew
+
+    print 'maskBadFHR: {} recordings  reference: {:0.2f}s  current: {:0.2f}s  speedup: {:0.1f}x'.format(
+        len(allRecno) - len(skipped), totalRef, totalNew, totalRef / max(totalNew, 1e-9))
+    if skipped:
+        print 'maskBadFHR: skipped {} recordings not handled by original: {}'.format(len(skipped), skipped)
+
+
+def runBenchmarks(recordPrefix=BASE_ctu_uhb_ctgdb, maxRecordings=None):
+    allRecno = getAllRecordingNumbers(recordPrefix)[:maxRecordings]
+    benchmarkMaskBadFHR(allRecno, recordPrefix=recordPrefix)
+
+
+if __name__ == '__main__':
+    runBenchmarks(recordPrefix=sys.argv[1] if len(sys.argv) > 1 else BASE_ctu_uhb_ctgdb,
+                  maxRecordings=int(sys.argv[2]) if len(sys.argv) > 2 else None)
@@ -0,0 +1,74 @@
+# coding: utf-8
+#
+#  Copyright Douglas Williams, 2017
+#  All Rights Reserved
+#
+
+import traceback
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import ctg_processing
+
+
+def _recordNames(records):
+    """Accepts record names or (recno, meta) pairs as generated by getSelectedRecordings"""
+    return [r[0] if isinstance(r, tuple) else r for r in records]
+
+
+def _processChunk(chunk, kwargs):
+    results = []
+    for src in chunk:
+        try:
+            results.append((src, ctg_processing.processRecordingCTG(src, **kwargs), None))
+        except Exception:
+            results.append((src, None, traceback.format_exc()))
+    return results
+
+
+def processRecordingsCTG(records, maxWorkers=None, chunkSize=1, ordered=True, maxPending=None, **kwargs):
+    """Applies processRecordingCTG to each record using a pool of worker processes
+
+    Inputs:
+       records - List of record names, or (recno, meta) pairs such as from getSelectedRecordings
+       maxWorkers - Number of worker processes (defaults to number of CPUs)
+       chunkSize - Number of records processed by each worker task
+       ordered - If True results are generated in order of records, otherwise as chunks complete
+       maxPending - Maximum chunks submitted ahead of consumer (defaults to twice number of workers)
+       kwargs - Parameters passed to processRecordingCTG
+
+    Generates (src, result, error) for each record, where error is None on success or the
+    formatted traceback if processing failed (in which case result is None).  If consumer stops
+    early, chunks not yet started are cancelled.
+    """
+    allSrc = _recordNames(records)
+    chunks = [allSrc[i:i + chunkSize] for i in range(0, len(allSrc), chunkSize)]
+    if maxPending is None:
+        maxPending = 2 * (maxWorkers or multiprocessing.cpu_count())
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        try:
+            for chunk in chunks:
+                while len(pending) >= maxPending:
+                    for entry in _nextCompleted(pending, ordered).result():
+                        yield entry
+                pending.append(executor.submit(_processChunk, chunk, kwargs))
+
+            while pending:
+                for entry in _nextCompleted(pending, ordered).result():
+                    yield entry
+        finally:
+            for future in pending:    # consumer stopped early
+                future.cancel()
+
+
+def _nextCompleted(pending, ordered):
+    """Removes and returns next future from pending, either in order or first to complete"""
+    if ordered:
+        return pending.popleft()
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    future = next(iter(done))
+    pending.remove(future)
+    return future
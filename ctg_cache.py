@@ -0,0 +1,117 @@
+# coding: utf-8
+#
+#  Copyright Douglas Williams, 2017
+#  All Rights Reserved
+#
+#  Content-addressed on-disk cache for intermediate results of processRecordingCTG.  Each
+#  stage is keyed on its own parameters together with keys of its upstream inputs, so
+#  changing a single parameter only recomputes stages depending on it.
+#
+
+import os
+import hashlib
+from os.path import join, isdir
+
+import numpy as np
+
+
+CACHE_VERSION = 1                    # increment when stage implementations change
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Default directory for StageCache when none given
+STAGE_CACHE_DIR = os.environ.get('CTG_STAGE_CACHE_DIR')
+
+
+def stageKey(stage, params=None, upstream=()):
+    """Key for result of stage given its parameters and keys of upstream inputs"""
+    params = sorted((params or {}).items())
+    desc = repr((CACHE_VERSION, stage, params, tuple(upstream)))
+    return hashlib.sha1(desc).hexdigest()
+
+
+class StageCache(object):
+    """Cache of numpy arrays stored as .npy files under cacheDir (defaults to STAGE_CACHE_DIR),
+       limited to maxBytes in total.  Entries are touched when read, and least recently used
+       entries are evicted first"""
+
+    def __init__(self, cacheDir=None, maxBytes=DEFAULT_MAX_BYTES):
+        if cacheDir is None:
+            cacheDir = STAGE_CACHE_DIR
+        if cacheDir is None:
+            raise Exception('StageCache requires cacheDir, or CTG_STAGE_CACHE_DIR to be set')
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self._totalBytes = None          # computed on first write
+        if not isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def _path(self, key):
+        return join(self.cacheDir, key + '.npy')
+
+    def get(self, key):
+        """Returns cached array for key, or None if not cached"""
+        path = self._path(key)
+        try:
+            result = np.load(path, allow_pickle=False)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return result
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmpPath = path + '.{}.tmp.npy'.format(os.getpid())
+        np.save(tmpPath, np.asarray(value), allow_pickle=False)
+        try:
+            replacedBytes = os.stat(path).st_size
+        except OSError:
+            replacedBytes = 0
+        os.rename(tmpPath, path)
+
+        if self._totalBytes is None:
+            self._totalBytes = sum(size for _, size, _ in self._allEntries())
+        else:
+            self._totalBytes += os.stat(path).st_size - replacedBytes
+        if self._totalBytes > self.maxBytes:
+            self.evict()
+
+    def getOrCompute(self, key, func):
+        """Returns cached result for key, otherwise calls func() and caches its result"""
+        result = self.get(key)
+        if result is None:
+            result = func()
+            self.put(key, result)
+        return result
+
+    def _allEntries(self):
+        """(mtime, size, path) for each cache entry"""
+        entries = []
+        for fname in os.listdir(self.cacheDir):
+            if not fname.endswith('.npy') or fname.endswith('.tmp.npy'):
+                continue
+            path = join(self.cacheDir, fname)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue     # removed by another process
+            entries.append((info.st_mtime, info.st_size, path))
+        return entries
+
+    def evict(self, maxBytes=None):
+        """Removes least recently used entries until total size is within maxBytes"""
+        if maxBytes is None:
+            maxBytes = self.maxBytes
+        entries = sorted(self._allEntries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._totalBytes = total
+
+    def clear(self):
+        self.evict(maxBytes=0)
@@ -5,24 +5,124 @@
 
 import numpy as np
 from scipy import signal
-import wfdb
 from pprint import pprint
 
 from scipy.interpolate import UnivariateSpline
 #from ehg_ctg_uc_extraction import filterSignal
 #from scipy.interpolate import InterpolatedUnivariateSpline
 from os.path import expanduser
+
+from ctg_record import getPhysionetRecord, sourceMtime
+from lru_cache import LRUCache
+from ctg_cache import stageKey
+from ctg_result import CTGResult
+from rolling_stats import rollingMaskedPercentile, rollingMedianStats
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None    # use pure python implementation of maskBadFHR loop
+
 home = expanduser("~")
 
 BASE_ctu_uhb_ctgdb = '/Volumes/Recordings/physionet/ctu-uhb-ctgdb'
 #BASE_ctu_uhb_ctgdb = home + '/Documents/ctg_recordings'
 
-def interpolateHR(sig, ts, mask, useLinear=True):
-    if not useLinear:
+MAX_FILTER_DESIGNS = 64
+_filterDesigns = LRUCache(MAX_FILTER_DESIGNS)
+
+def interpolateHR(sig, ts, mask, useLinear=True, method=None, context=8):
+    """Fills samples where mask is False, leaving valid samples unchanged.  Samples before
+       first (or after last) valid sample hold value of nearest valid sample.
+
+    method:
+       'linear' - Linear interpolation (default if useLinear)
+       'pchip' - Monotone piecewise cubic through valid samples
+       'spline' - Cubic fitted to context valid samples either side of each gap (default otherwise)
+       'global' - Single smoothing spline over entire recording, also replacing valid samples
+    """
+    if method is None:
+        method = 'linear' if useLinear else 'spline'
+    if method == 'global':
         sp = UnivariateSpline(ts[mask], sig[mask]) #, s=smoothing)
         return sp(ts)
+
+    validIdx = np.flatnonzero(mask)
+    fillIdx = np.flatnonzero(~np.asarray(mask, dtype=bool))
+    result = np.array(sig, dtype=np.float64)
+    result[fillIdx] = np.interp(ts[fillIdx], ts[validIdx], result[validIdx])
+    if method == 'linear' or len(validIdx) < 4:
+        return result
+
+    # only gaps between valid samples differ from linear
+    fillIdx = fillIdx[(fillIdx > validIdx[0]) & (fillIdx < validIdx[-1])]
+    if method == 'pchip':
+        result[fillIdx] = _pchipFill(ts[validIdx], result[validIdx], ts[fillIdx])
+    elif method == 'spline':
+        result[fillIdx] = _localCubicFill(ts, result, validIdx, fillIdx, context)
     else:
-        return np.interp(ts, ts[mask], sig[mask])
+        raise Exception('Unknown interpolation method: {}'.format(method))
+    return result
+
+
+def _pchipSlopeAtEdge(h0, h1, m0, m1):
+    d = ((2 * h0 + h1) * m0 - h0 * m1) / (h0 + h1)
+    if np.sign(d) != np.sign(m0):
+        return 0.0
+    if np.sign(m0) != np.sign(m1) and abs(d) > 3 * abs(m0):
+        return 3.0 * m0
+    return d
+
+
+def _pchipFill(x, y, xFill):
+    """Evaluates at xFill the same monotone piecewise cubic as PchipInterpolator(x, y), computing
+       slopes directly rather than constructing the full interpolator, which dominated runtime"""
+    h = np.diff(x)
+    m = np.diff(y) / h
+    w1 = 2 * h[1:] + h[:-1]
+    w2 = h[1:] + 2 * h[:-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        whmean = (w1 / m[:-1] + w2 / m[1:]) / (w1 + w2)
+        flat = (np.sign(m[1:]) != np.sign(m[:-1])) | (m[1:] == 0) | (m[:-1] == 0)
+        d = np.concatenate([[_pchipSlopeAtEdge(h[0], h[1], m[0], m[1])],
+                            np.where(flat, 0.0, 1.0 / whmean),
+                            [_pchipSlopeAtEdge(h[-1], h[-2], m[-1], m[-2])]])
+
+    k = np.clip(np.searchsorted(x, xFill) - 1, 0, len(x) - 2)
+    s = (xFill - x[k]) / h[k]
+    return ((2 * s ** 3 - 3 * s ** 2 + 1) * y[k] + (s ** 3 - 2 * s ** 2 + s) * h[k] * d[k] +
+            (-2 * s ** 3 + 3 * s ** 2) * y[k + 1] + (s ** 3 - s ** 2) * h[k] * d[k + 1])
+
+
+def _localCubicFill(ts, sig, validIdx, fillIdx, context):
+    """Evaluates at fillIdx a least-squares cubic fitted to up to context valid samples either side
+       of each gap, solving for all gaps together.  Clipped to range of context samples."""
+    context = max(context, 3)     # ensures at least 4 samples at either end of recording
+    before = np.flatnonzero(np.diff(validIdx) > 1)    # position in validIdx preceding each gap
+    ctxPos = before[:, np.newaxis] + np.arange(-context + 1, context + 1)
+    weight = ((ctxPos >= 0) & (ctxPos < len(validIdx))).astype(np.float64)
+    ctxPos = np.clip(ctxPos, 0, len(validIdx) - 1)
+
+    # fit in coordinates centred on each gap for conditioning
+    tLeft = ts[validIdx[before]]
+    tRight = ts[validIdx[before + 1]]
+    center = (tLeft + tRight) / 2.0
+    scale = (ts[validIdx[ctxPos[:, -1]]] - ts[validIdx[ctxPos[:, 0]]]) / 2.0
+    u = (ts[validIdx[ctxPos]] - center[:, np.newaxis]) / scale[:, np.newaxis]
+    y = sig[validIdx[ctxPos]]
+
+    V = u[..., np.newaxis] ** np.arange(4)
+    VW = V * weight[..., np.newaxis]
+    coef = np.linalg.solve(np.einsum('gki,gkj->gij', VW, V), np.einsum('gki,gk->gi', VW, y))
+
+    gap = np.searchsorted(validIdx, fillIdx) - 1
+    gap = np.searchsorted(validIdx[before], validIdx[gap])
+    uFill = (ts[fillIdx] - center[gap]) / scale[gap]
+    values = np.sum(coef[gap] * uFill[:, np.newaxis] ** np.arange(4), axis=1)
+
+    yLow = np.where(weight > 0, y, np.inf).min(axis=1)
+    yHigh = np.where(weight > 0, y, -np.inf).max(axis=1)
+    return np.clip(values, yLow[gap], yHigh[gap])
 
 
 
@@ -36,8 +136,9 @@ def filterUC(sig, freqLow=0.025, filt_order=4, fs_Hz=4.0):
 
 
 def computeBaseline(estHR, mask, baselinePad=None,
-                    perMin=60 * 4, minPerHist=10, pctValid=0.5, percentile=70, thresh=25):
-    """Estimates baseline using 10 minute median"""
+                    perMin=60 * 4, minPerHist=10, pctValid=0.5, percentile=70, thresh=25, quantum=0.25):
+    """Estimates baseline using 10 minute median.  Valid samples on a grid of quantum bpm use
+       histogram-based percentiles (see rollingMaskedPercentile)"""
 
     if baselinePad is None:
         baselinePad = (5, 5)
@@ -45,9 +146,8 @@ def computeBaseline(estHR, mask, baselinePad=None,
     minCount = N * pctValid
 
     # Initial estimate
-    mask10 = [np.sum(mask[i:i + N]) > minCount for i in range(0, len(estHR) - N, perMin)]
-    median10 = [np.percentile(estHR[i:i + N][mask[i:i + N]], percentile) if mask10[j] else 0
-                for j, i in enumerate(range(0, len(estHR) - N, perMin))]
+    mask10, median10 = rollingMaskedPercentile(estHR, mask, N, perMin, percentile, minCount=minCount,
+                                              quantum=quantum)
     maskMid10 = np.pad(mask10, (5, 5), 'edge')
     medianMid10 = np.pad(median10, (5, 5), 'edge')
     idx = np.arange(len(maskMid10)) * perMin
@@ -58,9 +158,8 @@ def computeBaseline(estHR, mask, baselinePad=None,
     revisedMask = np.copy(mask)
     revisedMask[np.abs(estHR - baseline) > thresh] = 0
 
-    mask10 = [np.sum(revisedMask[i:i + N]) > minCount for i in range(0, len(estHR) - N, perMin)]
-    median10 = [np.percentile(estHR[i:i + N][revisedMask[i:i + N]], percentile) if mask10[j] else 0
-                for j, i in enumerate(range(0, len(estHR) - N, perMin))]
+    mask10, median10 = rollingMaskedPercentile(estHR, revisedMask, N, perMin, percentile, minCount=minCount,
+                                              quantum=quantum)
     maskMid10 = np.pad(mask10, baselinePad, 'edge')
     medianMid10 = np.pad(median10, baselinePad, 'edge')
     idx = np.arange(len(maskMid10)) * perMin
@@ -71,7 +170,8 @@ def computeBaseline(estHR, mask, baselinePad=None,
 
 def altComputeBaseline(estHR, mask,
                        segmentSizeInMin=4, samplesPerMin=60 * 4, pctValid=0.5,
-                       percentile=70, thresh=10, includePoints=False):
+                       percentile=70, thresh=10, includePoints=False,
+                       stepSize=None, quantum=0.25):
     """Estimates baseline using 4 minute median of prior samples after excluding regions with
        high absolute deviation from segment median
 
@@ -83,30 +183,19 @@ def altComputeBaseline(estHR, mask,
        pctValid - Fraction of valid samples required in order to compute validate baseline
        percentile - Percentile absolute deviation from median when computing segment stability
        thresh - Maximum allowable deviation (rel to percentile) to be considered stable segment
+       stepSize - Number of samples between segments, defaults to samplesPerMin
+       quantum - Resolution of FHR values, enabling histogram-based segment statistics
        """
 
     # Compute medians and median absolute difference for different segments and look for stability
     perSeg = segmentSizeInMin * samplesPerMin
-    perHalfSeg = perSeg // 2
-    # allMedians = [(i, med, np.median(np.abs(seg - med)),
-    #                np.percentile(np.abs(seg - med), percentile))
-    #               #for i in range(perSeg, len(estHR), perHalfSeg // 2)
-    #               for i in range(perSeg, len(estHR), samplesPerMin)
-    #               for seg in [estHR[i - perSeg:i][mask[i - perSeg:i]]]
-    #               for med in [np.median(seg)]
-    #               if np.sum(mask[i - perSeg:i]) > pctValid * perSeg]
-
-    allSegs = [(i, estHR[i - perSeg:i][mask[i - perSeg:i]])
-                  #for i in range(perSeg, len(estHR), perHalfSeg // 2)
-                  for i in range(perSeg, len(estHR), samplesPerMin)
-                  for seg in [estHR[i - perSeg:i][mask[i - perSeg:i]]]
-                  if np.sum(mask[i - perSeg:i]) > pctValid * perSeg]
-
-
-    allMedians = [(i, med, np.median(np.abs(seg - med)),
-                   np.percentile(np.abs(seg - med), percentile))
-                  for i, seg in allSegs
-                  for med in [np.median(seg)]]
+    if stepSize is None:
+        stepSize = samplesPerMin
+
+    starts, segValid, med, mad, pctDev = rollingMedianStats(estHR, mask, perSeg, stepSize, percentile,
+                                                            minCount=pctValid * perSeg, quantum=quantum)
+    allMedians = zip((starts[segValid] + perSeg).tolist(), med[segValid].tolist(),
+                     mad[segValid].tolist(), pctDev[segValid].tolist())
 
     valid = [x for x in allMedians if x[3] < thresh]
     # print 'valid:', len(valid)
@@ -129,26 +218,29 @@ def altComputeBaseline(estHR, mask,
 
 
 
+def _cachedStage(cache, key, func):
+    if cache is None:
+        return func()
+    return cache.getOrCompute(key, func)
+
+
 def processRecordingCTG(src,
                         freqLow=0.0125 / 2, # freqLow=0.0125 / 16,
                         freqHigh=0.0125, freqHigh2=0.0125 * 2, baselinePad=None,
                         blackoutLeft=10, blackoutRight=10,
-                        recordPrefix=BASE_ctu_uhb_ctgdb):
-    recordName = recordPrefix + '/' + src
-    # ctgRecord = wfdb.rdsamp(fname)
-    sig, fields = wfdb.srdsamp(recordName)
-
-    # print sig.shape
-    fs = fields['fs']
-    signames = fields['signame']
-    units = fields['units']
-    comments = fields['comments']
+                        recordPrefix=BASE_ctu_uhb_ctgdb, cache=None, interpMethod='linear'):
+    """Processes CTU-UHB recording, returning CTGResult (which unpacks as tuple of ts, rawFHR, estHR,
+       mask, baseline, smoothLowHR, rawUC, smoothHighHR, smoothHighHR2, filtUC, history, artifacts).
+       interpMethod selects gap interpolation used by interpolateHR.  If cache (a ctg_cache.StageCache)
+       is given, each stage is taken from cache when its parameters and upstream inputs are unchanged"""
+    record = getPhysionetRecord(src, recordPrefix)
+    comments = record.comments
 
-    #pprint(fields)
+    ts = record.ts
+    rawFHR = record.rawFHR
+    rawUC = record.rawUC
 
-    ts = np.arange(sig.shape[0]) / float(fs) / 60.0
-    rawFHR = sig[:, 0]
-    rawUC = sig[:, 1]
+    recordKey = stageKey('record', {'name': record.recordName, 'mtime': sourceMtime(record.recordName)})
 
     # Compute Mask, applying black-out to neighboring points
     # mask = rawFHR > 0
@@ -157,35 +249,60 @@ def processRecordingCTG(src,
     #     if mask2[i] == 0:
     #         mask[max(i - blackoutLeft, 0): min(i + blackoutRight, len(mask))] = 0
 
-    mask = maskBadFHR(rawFHR)
-    mask = dialateMaskFHR(mask, blackoutLeft=blackoutLeft, blackoutRight=blackoutRight)
-    estHR = interpolateHR(rawFHR, ts, mask)  # iterpolate missing datapoints
+    maskKey = stageKey('mask', {'blackoutLeft': blackoutLeft, 'blackoutRight': blackoutRight}, [recordKey])
+    mask = _cachedStage(cache, maskKey, lambda: dialateMaskFHR(maskBadFHR(rawFHR), blackoutLeft=blackoutLeft,
+                                                                 blackoutRight=blackoutRight))
 
-
-    #baseline = computeBaseline(estHR, mask, baselinePad=baselinePad)
-    baseline = altComputeBaseline(estHR, mask)
+    interpKey = stageKey('interpolateHR', {'method': interpMethod}, [recordKey, maskKey])
+    estHR = _cachedStage(cache, interpKey,
+                         lambda: interpolateHR(rawFHR, ts, mask, method=interpMethod))  # iterpolate missing datapoints
 
 
-    minVal = np.min(rawFHR[mask])  # clip extreme values
-    estHR[estHR < minVal] = minVal
-    estHR[estHR > 200] = 200
-    smoothLowHR = filterUC(estHR, freqLow=freqLow, filt_order=4, fs_Hz=4.0)
-    smoothHighHR = filterUC(estHR, freqLow=freqHigh, filt_order=4, fs_Hz=4.0)
-    smoothHighHR2 = filterUC(estHR, freqLow=freqHigh2, filt_order=4, fs_Hz=4.0)
+    #baseline = computeBaseline(estHR, mask, baselinePad=baselinePad)
+    baselineKey = stageKey('altComputeBaseline', {}, [interpKey, maskKey])
+    baseline = _cachedStage(cache, baselineKey, lambda: altComputeBaseline(estHR, mask))
+
+
+    def clipHR():
+        minVal = np.min(rawFHR[mask])  # clip extreme values
+        clipped = np.copy(estHR)
+        clipped[clipped < minVal] = minVal
+        clipped[clipped > 200] = 200
+        return clipped
+
+    clipKey = stageKey('clipHR', {'maxHR': 200}, [recordKey, interpKey, maskKey])
+    estHR = _cachedStage(cache, clipKey, clipHR)
+
+    # smoothing bands are cached individually, computing any missing bands in a single pass
+    allFreqs = [freqLow, freqHigh, freqHigh2]
+    bandKeys = [stageKey('smoothHR', {'freq': freq, 'order': 4, 'fs_Hz': 4.0}, [clipKey]) for freq in allFreqs]
+    allSmooth = [cache.get(key) if cache is not None else None for key in bandKeys]
+    missing = [i for i, smooth in enumerate(allSmooth) if smooth is None]
+    if missing:
+        for i, smooth in zip(missing, filterBands(estHR, [allFreqs[i] for i in missing], order=4, fs_Hz=4.0)):
+            allSmooth[i] = smooth
+            if cache is not None:
+                cache.put(bandKeys[i], smooth)
+    smoothLowHR, smoothHighHR, smoothHighHR2 = allSmooth
+
+    ucKey = stageKey('filterUC', {'freqLow': 0.025, 'filt_order': 4, 'fs_Hz': 4.0}, [recordKey])
+    filtUC = _cachedStage(cache, ucKey, lambda: filterUC(rawUC, freqLow=0.025, filt_order=4, fs_Hz=4.0))
+
+    history = summarizeHistory(comments)
+    artifacts = "\n".join(['Placeholder'])
 
-    filtUC = filterUC(rawUC, freqLow=0.025, filt_order=4, fs_Hz=4.0)
+    return CTGResult(record.fs, rawFHR, estHR, mask, baseline, smoothLowHR, rawUC,
+                     smoothHighHR, smoothHighHR2, filtUC, history=history, artifacts=artifacts)
 
+def summarizeHistory(comments):
+    """Selects clinical history from recording header comments"""
     selected_params = ['pH', 'BDecf', 'pCO2', 'BE', 'Apgar1', 'Apgar5',
                        'Gest. weeks', 'Weight(g)', 'Sex',
                        'Age', 'Gravidity', 'Parity', 'Diabetes ','Hypertension', 'Preeclampsia',
                        'Liq.', 'Pyrexia', 'Meconium',
                        'Presentation', 'Induced', 'I.stage', 'NoProgress', 'CK/KP', 'II.stage', 'Deliv']
 
-    history = "\n".join([x for x in comments if startsWithAny(x, selected_params)])
-    artifacts = "\n".join(['Placeholder'])
-
-    return (ts, rawFHR, estHR, mask, baseline, smoothLowHR, rawUC,
-            smoothHighHR, smoothHighHR2, filtUC, history, artifacts)
+    return "\n".join([x for x in comments if startsWithAny(x, selected_params)])
 
 def startsWithAny(val, all_prefix):
      for pre in all_prefix:
@@ -193,92 +310,249 @@ def startsWithAny(val, all_prefix):
              return True
      return False
 
-def oldMaskBadFHR(rawFHR, blackoutLeft=5, blackoutRight=15):
-    # Compute Mask, applying black-out to neighboring points
-    mask = rawFHR > 0
-    mask2 = np.copy(mask)
-    for i in range(len(mask)):
-        if mask2[i] == 0:
-            mask[max(i-blackoutLeft, 0): min(i+blackoutRight, len(mask))] = 0
-    return mask
+def dilateMask(mask, blackoutLeft=10, blackoutRight=10, out=None):
+    """Applies black-out to neighbors of invalid samples, where each invalid sample i clears
+       mask[i - blackoutLeft:i + blackoutRight].  Vectorized using cumulative count of invalid
+       samples, so cost is independent of blackout width.
 
-def dialateMaskFHR(mask, blackoutLeft=10, blackoutRight=10):
-    # Compute Mask, applying black-out to neighboring points
-    mask2 = np.copy(mask)
-    for i in range(len(mask)):
-        if mask2[i] == 0:
-            mask[max(i-blackoutLeft, 0): min(i+blackoutRight, len(mask))] = 0
-    return mask
+    Inputs:
+       mask - Mask indicating valid samples, 1-D or 2-D batch of masks (black-out along last axis)
+       blackoutLeft, blackoutRight - Black-out applied before and after each invalid sample
+       out - Array receiving result (may be mask itself for in-place update), defaults to copy
+    """
+    n = mask.shape[-1]
+    counts = np.zeros(mask.shape[:-1] + (n + 1,), dtype=np.int32)
+    np.cumsum(mask == 0, axis=-1, out=counts[..., 1:])
+
+    # sample j is cleared if any invalid samples within [j - blackoutRight + 1, j + blackoutLeft]
+    idx = np.arange(n)
+    lo = np.clip(idx - blackoutRight + 1, 0, n)
+    hi = np.maximum(np.clip(idx + blackoutLeft + 1, 0, n), lo)
+    blackout = counts[..., hi] > counts[..., lo]
+
+    if out is None:
+        out = np.copy(mask)
+    out[blackout] = 0
+    return out
 
 
-def maskBadFHR(rawFHR, pctLow=0.65, pctHigh=1.75, samplesPerSecond=4):
-    """Mask badFHR using algorithm in Dawes Redman Criteria"""
+def oldMaskBadFHR(rawFHR, blackoutLeft=5, blackoutRight=15):
     # Compute Mask, applying black-out to neighboring points
-    inputMask = rawFHR > 0
-    if sum(inputMask) == 0:
-        return inputMask   # no valid data
+    mask = rawFHR > 0
+    return dilateMask(mask, blackoutLeft=blackoutLeft, blackoutRight=blackoutRight, out=mask)
 
-    outputMask = np.copy(inputMask)
+def dialateMaskFHR(mask, blackoutLeft=10, blackoutRight=10):
+    # Compute Mask, applying black-out to neighboring points (updates mask in-place)
+    return dilateMask(mask, blackoutLeft=blackoutLeft, blackoutRight=blackoutRight, out=mask)
 
-    if not inputMask[0] or not inputMask[1]:
-        # use first minute as reference:
-        segLen = 60 * samplesPerSecond   # 60 seconds @ 4 samplesPerSecond
-        i = 0
-        while sum(inputMask[i:i+segLen]) == 0:
-            if i < len(inputMask) - segLen:
-                i += segLen
-                print 'maskBadFHR skipping to next minute', i
-            else:
-                print 'maskBadFHR -- no valid data'
-                return inputMask
-        seg = rawFHR[i:i+segLen][inputMask[i:i+segLen]]
-
-        medVal = np.median(seg)  # use median as starting point
-        if not inputMask[0]:
-            first = medVal
-        if not inputMask[1]:
-            second = medVal
-    else:
-        first = rawFHR[0]
-        second = rawFHR[1]
 
-    for i in range(2, len(rawFHR)):
+def _maskBadFHRLoop(rawFHR, inputMask, outputMask, start, first, second, pctLow, pctHigh):
+    """Dawes Redman artifact detection loop, shared by numba and pure python implementations.
+       Returns updated reference values and number of samples beyond end still to be masked"""
+    n = len(rawFHR)
+    clearUntil = 0
+    for i in range(start, n):
         if not inputMask[i]:
             continue
         thresh = (first + second) / 2.0
         if rawFHR[i] < pctLow * thresh or rawFHR[i] > pctHigh * thresh:
-            outputMask[i:min(i + 3, len(outputMask))] = 0
+            clearUntil = i + 3
+            for j in range(i, min(clearUntil, n)):
+                outputMask[j] = False
         else:
             first = second
             second = rawFHR[i]
+    return first, second, max(clearUntil - n, 0)
+
+
+if njit is not None:
+    _maskBadFHRLoopCompiled = njit(cache=True)(_maskBadFHRLoop)
+
+
+def runMaskBadFHRLoop(rawFHR, inputMask, outputMask, start, first, second, pctLow, pctHigh):
+    """Runs artifact detection loop, updating outputMask in-place.  Uses numba when available,
+       otherwise operates on python lists which avoids per-element numpy scalar overhead"""
+    if njit is not None:
+        return _maskBadFHRLoopCompiled(np.asarray(rawFHR, dtype=np.float64), inputMask, outputMask,
+                                       start, float(first), float(second), pctLow, pctHigh)
+
+    out = outputMask.tolist()
+    result = _maskBadFHRLoop(rawFHR.tolist(), inputMask.tolist(), out,
+                             start, float(first), float(second), pctLow, pctHigh)
+    outputMask[:] = out
+    return result
+
+
+def initialReferenceFHR(rawFHR, inputMask, samplesPerSecond=4):
+    """Returns initial (first, second) reference values for maskBadFHR, using median of first
+       minute containing valid data in place of invalid starting samples.  None if no valid data"""
+    if inputMask[0] and inputMask[1]:
+        return rawFHR[0], rawFHR[1]
+
+    # use first minute as reference:
+    segLen = 60 * samplesPerSecond   # 60 seconds @ 4 samplesPerSecond
+    i = 0
+    while np.count_nonzero(inputMask[i:i+segLen]) == 0:
+        if i < len(inputMask) - segLen:
+            i += segLen
+            print 'maskBadFHR skipping to next minute', i
+        else:
+            print 'maskBadFHR -- no valid data'
+            return None
+    seg = rawFHR[i:i+segLen][inputMask[i:i+segLen]]
+
+    medVal = np.median(seg)  # use median as starting point
+    first = rawFHR[0] if inputMask[0] else medVal
+    second = rawFHR[1] if inputMask[1] else medVal
+    return first, second
+
+
+def maskBadFHR(rawFHR, pctLow=0.65, pctHigh=1.75, samplesPerSecond=4):
+    """Mask badFHR using algorithm in Dawes Redman Criteria"""
+    # Compute Mask, applying black-out to neighboring points
+    inputMask = rawFHR > 0
+    if np.count_nonzero(inputMask) == 0:
+        return inputMask   # no valid data
+
+    reference = initialReferenceFHR(rawFHR, inputMask, samplesPerSecond=samplesPerSecond)
+    if reference is None:
+        return inputMask
+
+    outputMask = np.copy(inputMask)
+    first, second = reference
+    runMaskBadFHRLoop(rawFHR, inputMask, outputMask, 2, first, second, pctLow, pctHigh)
 
     return outputMask
 
 
-def filterSignal(sig, fType='lowpass', useFiltFilt=True, fs_Hz=1000.0, freq=100.0, order=1):
-    """Applies lowpass or highpass filter to signal"""
+def designFilter(fType='lowpass', freq=100.0, order=1, fs_Hz=1000.0):
+    """Returns Butterworth filter as dict containing transfer function (b, a), second-order
+       sections (sos) and steady-state initial conditions for each (zi, sosZi).
+       Designs are memoized, keyed by (fType, freq, order, fs_Hz) with LRU eviction"""
+    key = (fType, freq, order, fs_Hz)
+    design = _filterDesigns.get(key)
+    if design is not None:
+        return design
 
-    # CreateFilter
     if fType not in ['lowpass', 'highpass']:
         raise Exception('Invalid filter type: {}'.format(fType))
     fNyquist = fs_Hz / 2.0
     order = min(order, max(int(fs_Hz / freq) - 1, 1))  # limit order to avoid oscillations
     b, a = signal.butter(order, freq / fNyquist, fType)
-    if not useFiltFilt:
-        zi = signal.lfilter_zi(b, a)
-
-    if len(sig.shape) > 1:
+    sos = signal.butter(order, freq / fNyquist, fType, output='sos')
+    design = {'b': b, 'a': a, 'zi': signal.lfilter_zi(b, a),
+              'sos': sos, 'sosZi': signal.sosfilt_zi(sos), 'order': order}
+    for v in design.values():
+        if isinstance(v, np.ndarray):
+            v.setflags(write=False)   # shared between callers
+
+    _filterDesigns.put(key, design)
+    return design
+
+
+def oddExtend(sig, padlen):
+    """Odd extension of signal at both ends along last axis, as used by signal.filtfilt"""
+    if sig.shape[-1] <= padlen:
+        raise ValueError('The length of the input vector x must be greater than padlen, '
+                         'which is {}.'.format(padlen))
+    if padlen == 0:
+        return sig
+    leftEnd = sig[..., :1]
+    rightEnd = sig[..., -1:]
+    return np.concatenate((2 * leftEnd - sig[..., padlen:0:-1], sig,
+                           2 * rightEnd - sig[..., -2:-(padlen + 2):-1]), axis=-1)
+
+
+def _filtfiltExtended(design, ext, padlen):
+    zi = design['zi'].reshape((1,) * (ext.ndim - 1) + (-1,))
+    y, _ = signal.lfilter(design['b'], design['a'], ext, zi=zi * ext[..., :1])
+    y, _ = signal.lfilter(design['b'], design['a'], y[..., ::-1], zi=zi * y[..., -1:])
+    y = y[..., ::-1]
+    return y[..., padlen:-padlen] if padlen > 0 else y
+
+
+def filtfiltDesign(design, sig):
+    """Forward-backward filter along last axis using precomputed filter design.
+       Equivalent to signal.filtfilt(b, a, sig) without recomputing initial conditions"""
+    padlen = 3 * max(len(design['a']), len(design['b']))
+    return _filtfiltExtended(design, oddExtend(sig, padlen), padlen)
+
+
+def filterBands(sig, freqs, fType='lowpass', order=4, fs_Hz=4.0):
+    """Applies bank of forward-backward filters, one for each cutoff frequency in freqs, to signal.
+       Padding is shared between bands.  Each band matches filterSignal(sig, freq=freqs[i], ...)
+
+    Returns:
+       Array of shape (len(freqs), len(sig))
+    """
+    result = np.empty((len(freqs),) + sig.shape)
+    allExt = {}
+    for i, freq in enumerate(freqs):
+        design = designFilter(fType=fType, freq=freq, order=order, fs_Hz=fs_Hz)
+        padlen = 3 * max(len(design['a']), len(design['b']))
+        if padlen not in allExt:
+            allExt[padlen] = oddExtend(sig, padlen)
+        result[i] = _filtfiltExtended(design, allExt[padlen], padlen)
+    return result
+
+
+def filterSignal(sig, fType='lowpass', useFiltFilt=True, fs_Hz=1000.0, freq=100.0, order=1,
+                 useSOS=False, padlen=None):
+    """Applies lowpass or highpass filter to signal, or to each row of 2-D batch of signals
+
+    useSOS selects second-order sections, which remain numerically stable at very low cutoff
+    frequencies.  padlen sets forward-backward filter padding (defaults to that of filtfilt
+    or sosfiltfilt).
+    """
+
+    design = designFilter(fType=fType, freq=freq, order=order, fs_Hz=fs_Hz)
+
+    if useSOS:
         if useFiltFilt:
-            newSig = np.vstack([signal.filtfilt(b, a, sig[i])
-                                for i in range(sig.shape[0])])
-        else:
-            newSig = np.vstack([signal.lfilter(b, a, sig[i], zi=zi * sig[i, 0])[0]
-                                for i in range(sig.shape[0])])
-    else:
+            return signal.sosfiltfilt(design['sos'], sig, axis=-1, padlen=padlen)
+        zi = design['sosZi'].reshape((design['sosZi'].shape[0],) + (1,) * (sig.ndim - 1) + (2,))
+        newSig, _ = signal.sosfilt(design['sos'], sig, axis=-1, zi=zi * sig[..., 0, np.newaxis])
+        return newSig
+
+    if useFiltFilt:
+        if padlen is None:
+            return filtfiltDesign(design, sig)
+        return _filtfiltExtended(design, oddExtend(sig, padlen), padlen)
+
+    zi = design['zi'].reshape((1,) * (sig.ndim - 1) + (-1,))
+    newSig, _ = signal.lfilter(design['b'], design['a'], sig, zi=zi * sig[..., :1])
+    return newSig
 
-        if useFiltFilt:
-            newSig = signal.filtfilt(b, a, sig)
-        else:
-            newSig, _ = signal.lfilter(b, a, sig, zi=zi * sig[0])
 
-    return newSig
+def filterRecordings(allSig, fType='lowpass', useFiltFilt=True, fs_Hz=1000.0, freq=100.0, order=1,
+                     useSOS=True, padlen=None, method='group'):
+    """Applies filterSignal to list of recordings of differing lengths using batched 2-D filtering
+
+    Inputs:
+       method - 'group' filters recordings of equal length together, matching individual results.
+                'pad' extends all recordings to a common length by repeating their final value
+                and filters as a single batch, so results differ close to end of shorter recordings.
+    Returns:
+       List of filtered recordings, in same order as allSig
+    """
+    kwargs = dict(fType=fType, useFiltFilt=useFiltFilt, fs_Hz=fs_Hz, freq=freq, order=order,
+                  useSOS=useSOS, padlen=padlen)
+    result = [None] * len(allSig)
+    if method == 'group':
+        byLength = {}
+        for i, sig in enumerate(allSig):
+            byLength.setdefault(len(sig), []).append(i)
+        for idx in byLength.values():
+            filtered = filterSignal(np.vstack([allSig[i] for i in idx]), **kwargs)
+            for row, i in enumerate(idx):
+                result[i] = filtered[row]
+    elif method == 'pad':
+        N = max([len(sig) for sig in allSig])
+        batch = np.vstack([np.pad(np.asarray(sig, dtype=np.float64), (0, N - len(sig)), 'edge')
+                           for sig in allSig])
+        filtered = filterSignal(batch, **kwargs)
+        for i, sig in enumerate(allSig):
+            result[i] = filtered[i, :len(sig)]
+    else:
+        raise Exception('Invalid method: {}'.format(method))
+    return result
@@ -0,0 +1,194 @@
+# coding: utf-8
+#
+#  Copyright Douglas Williams, 2017
+#  All Rights Reserved
+#
+
+import hashlib
+import os
+import pickle
+from os.path import isfile, join, basename
+
+import numpy as np
+
+from lru_cache import LRUCache
+
+
+MAX_CACHED_RECORDS = 16
+
+# Directory for memory-mapped copies of decoded signals, disabled if None
+SIGNAL_CACHE_DIR = os.environ.get('CTG_SIGNAL_CACHE_DIR')
+
+
+def parseToken(tok):
+    try:
+        return int(tok)
+    except Exception:
+        try:
+            return float(tok)
+        except Exception:
+            return tok
+
+
+def readPhysionetHeader(recordName):
+    """Returns comments from WFDB header (.hea) file without decoding the signal"""
+    comments = []
+    with open(recordName + '.hea', 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#'):
+                comments.append(line[1:].strip())
+    return comments
+
+
+def parseHeaderComments(comments):
+    """Converts CTU-UHB header comments (eg: 'Gest. weeks  37') into dict of field values"""
+    meta = {}
+    for entry in comments:
+        tokens = entry.split()
+        if len(tokens) < 2 or tokens[0].startswith('-'):
+            continue   # section separator
+        meta[' '.join(tokens[:-1])] = parseToken(tokens[-1])
+    return meta
+
+
+def sourceMtime(recordName):
+    """Latest modification time of WFDB header and signal files for recordName"""
+    mtime = os.stat(recordName + '.hea').st_mtime
+    if isfile(recordName + '.dat'):
+        mtime = max(mtime, os.stat(recordName + '.dat').st_mtime)
+    return mtime
+
+
+def _signalCacheFiles(cacheDir, recordName):
+    """Cache files named by record and hash of its full path, since databases may share record names"""
+    pathHash = hashlib.sha1(os.path.abspath(recordName)).hexdigest()[:16]
+    base = join(cacheDir, '{}.{}'.format(basename(recordName), pathHash))
+    return base + '.npy', base + '.fields.p'
+
+
+def loadCachedSignal(recordName, cacheDir):
+    """Returns (sig, fields) from signal cache as read-only memory-mapped view,
+       or (None, None) if record not cached or source modified since cached"""
+    sigFile, fieldsFile = _signalCacheFiles(cacheDir, recordName)
+    if not isfile(fieldsFile):
+        return None, None
+    with open(fieldsFile, 'rb') as f:
+        entry = pickle.load(f)
+    if entry['path'] != os.path.abspath(recordName) or entry['mtime'] != sourceMtime(recordName):
+        return None, None
+    sig = np.load(sigFile, mmap_mode='r')
+    return sig.T, entry['fields']   # stored channel-major so each channel is contiguous
+
+
+def saveCachedSignal(recordName, cacheDir, sig, fields):
+    """Saves decoded signal to cache, as float32 when this is lossless"""
+    sigFile, fieldsFile = _signalCacheFiles(cacheDir, recordName)
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+
+    stored = np.ascontiguousarray(sig.T)
+    if np.array_equal(stored.astype(np.float32), stored):
+        stored = stored.astype(np.float32)
+    np.save(sigFile + '.tmp.npy', stored)
+    os.rename(sigFile + '.tmp.npy', sigFile)
+
+    with open(fieldsFile + '.tmp', 'wb') as f:
+        pickle.dump({'path': os.path.abspath(recordName), 'mtime': sourceMtime(recordName), 'fields': fields},
+                    f, pickle.HIGHEST_PROTOCOL)
+    os.rename(fieldsFile + '.tmp', fieldsFile)
+
+
+class PhysionetRecord(object):
+    """WFDB recording with lazily loaded header and signal.  Signal is decoded at most once,
+       header comments are read directly from .hea file unless signal already decoded.
+
+       If cacheDir is given, decoded signal is taken from (or saved to) memory-mapped signal cache"""
+
+    def __init__(self, recordName, cacheDir=None):
+        self.recordName = recordName
+        self.cacheDir = cacheDir
+        self._comments = None
+        self._meta = None
+        self._sig = None
+        self._fields = None
+
+    def _decode(self):
+        if self._sig is not None:
+            return
+        if self.cacheDir:
+            self._sig, self._fields = loadCachedSignal(self.recordName, self.cacheDir)
+            if self._sig is not None:
+                return
+
+        import wfdb    # only needed when decoding, so cached signals and headers are usable without it
+        self._sig, self._fields = wfdb.srdsamp(self.recordName)
+        if self.cacheDir:
+            try:
+                saveCachedSignal(self.recordName, self.cacheDir, self._sig, self._fields)
+            except (IOError, OSError), e:
+                print 'PhysionetRecord: unable to cache signal for', self.recordName, e
+
+    @property
+    def comments(self):
+        if self._comments is None:
+            if self._fields is not None:
+                self._comments = self._fields['comments']
+            else:
+                self._comments = readPhysionetHeader(self.recordName)
+        return self._comments
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            self._meta = parseHeaderComments(self.comments)
+        return self._meta
+
+    @property
+    def sig(self):
+        self._decode()
+        return self._sig
+
+    @property
+    def fields(self):
+        self._decode()
+        return self._fields
+
+    @property
+    def fs(self):
+        return self.fields['fs']
+
+    @property
+    def rawFHR(self):
+        return self.sig[:, 0]
+
+    @property
+    def rawUC(self):
+        return self.sig[:, 1]
+
+    @property
+    def ts(self):
+        """Timescale in minutes"""
+        return np.arange(self.sig.shape[0]) / float(self.fs) / 60.0
+
+
+_recordCache = LRUCache(MAX_CACHED_RECORDS)
+
+
+def getPhysionetRecord(src, recordPrefix, cacheDir=None):
+    """Returns PhysionetRecord for src, reusing previously loaded record within session
+       unless its header has since been modified.  cacheDir defaults to SIGNAL_CACHE_DIR"""
+    recordName = recordPrefix + '/' + src
+    if cacheDir is None:
+        cacheDir = SIGNAL_CACHE_DIR
+    mtime = os.stat(recordName + '.hea').st_mtime
+
+    entry = _recordCache.get(recordName)
+    if entry is None or entry[0] != mtime or entry[1].cacheDir != cacheDir:
+        entry = (mtime, PhysionetRecord(recordName, cacheDir=cacheDir))
+        _recordCache.put(recordName, entry)
+    return entry[1]
+
+
+def clearRecordCache():
+    _recordCache.clear()
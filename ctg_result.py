@@ -0,0 +1,93 @@
+# coding: utf-8
+#
+#  Copyright Douglas Williams, 2017
+#  All Rights Reserved
+#
+
+import numpy as np
+
+
+SIGNAL_DTYPE = np.float32
+
+# Order of fields when unpacked, matching tuple previously returned by processRecordingCTG
+RESULT_FIELDS = ('ts', 'rawFHR', 'estHR', 'mask', 'baseline', 'smoothLowHR', 'rawUC',
+                 'smoothHighHR', 'smoothHighHR2', 'filtUC', 'history', 'artifacts')
+
+SIGNAL_FIELDS = ('rawFHR', 'estHR', 'baseline', 'smoothLowHR', 'rawUC',
+                 'smoothHighHR', 'smoothHighHR2', 'filtUC')
+
+
+class CTGResult(object):
+    """Compact result of processRecordingCTG.  Signals are stored as float32 and mask as
+       packed bits, with ts derived from fs on access.  Unpacks in same order as the tuple
+       previously returned:
+
+           ts, rawFHR, estHR, mask, baseline, smoothLowHR, rawUC, \\
+               smoothHighHR, smoothHighHR2, filtUC, history, artifacts = result
+    """
+    __slots__ = ('fs', 'n', 'history', 'artifacts', '_packedMask') + SIGNAL_FIELDS
+
+    def __init__(self, fs, rawFHR, estHR, mask, baseline, smoothLowHR, rawUC,
+                 smoothHighHR, smoothHighHR2, filtUC, history='', artifacts=''):
+        self.fs = float(fs)
+        self.n = len(rawFHR)
+        self.history = history
+        self.artifacts = artifacts
+        self._packedMask = np.packbits(np.asarray(mask, dtype=bool))
+        for name, sig in zip(SIGNAL_FIELDS, [rawFHR, estHR, baseline, smoothLowHR, rawUC,
+                                             smoothHighHR, smoothHighHR2, filtUC]):
+            setattr(self, name, np.asarray(sig, dtype=SIGNAL_DTYPE))
+
+    @property
+    def ts(self):
+        """Timescale in minutes"""
+        return np.arange(self.n) / self.fs / 60.0
+
+    @property
+    def mask(self):
+        return np.unpackbits(self._packedMask)[:self.n].astype(bool)
+
+    @property
+    def nbytes(self):
+        return self._packedMask.nbytes + sum(getattr(self, name).nbytes for name in SIGNAL_FIELDS)
+
+    def __iter__(self):
+        for name in RESULT_FIELDS:
+            yield getattr(self, name)
+
+    def __len__(self):
+        return len(RESULT_FIELDS)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(getattr(self, name) for name in RESULT_FIELDS[i])
+        return getattr(self, RESULT_FIELDS[i])
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def save(self, fname):
+        """Saves result as .npz without use of pickle"""
+        allSig = dict((name, getattr(self, name)) for name in SIGNAL_FIELDS)
+        np.savez(fname, fs=np.array(self.fs), n=np.array(self.n), packedMask=self._packedMask,
+                 history=np.array(self.history), artifacts=np.array(self.artifacts), **allSig)
+
+    @classmethod
+    def load(cls, fname):
+        result = cls.__new__(cls)
+        data = np.load(fname, allow_pickle=False)
+        try:
+            result.fs = float(data['fs'])
+            result.n = int(data['n'])
+            result.history = data['history'].item()
+            result.artifacts = data['artifacts'].item()
+            result._packedMask = data['packedMask']
+            for name in SIGNAL_FIELDS:
+                setattr(result, name, data[name])
+        finally:
+            data.close()
+        return result
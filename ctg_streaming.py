@@ -0,0 +1,455 @@
+# coding: utf-8
+#
+#  Copyright Douglas Williams, 2017
+#  All Rights Reserved
+#
+#  Incremental versions of ctg_processing stages for FHR and UC arriving in chunks
+#  (eg: live feeds from low-cost CTG units).  Each stage accepts chunks via push() and
+#  returns output for those samples that can no longer change, with finish() flushing
+#  any remaining samples at end of recording.
+#
+
+import numpy as np
+from scipy import signal
+
+from ctg_processing import dilateMask, runMaskBadFHRLoop, designFilter, summarizeHistory
+from ctg_processing import BASE_ctu_uhb_ctgdb
+from ctg_record import getPhysionetRecord
+from ctg_result import CTGResult
+
+
+class StreamingFHRMasker(object):
+    """Incremental equivalent of dialateMaskFHR(maskBadFHR(rawFHR)).  Concatenated output of
+       push() and finish() matches the batch mask exactly.
+
+       Artifact detection carries the Dawes Redman reference values and any pending artifact
+       black-out between chunks.  Output is delayed by blackoutLeft samples, since a later
+       invalid sample can still clear earlier ones, and while the initial reference is being
+       established when recording starts with invalid samples (at most one minute).
+    """
+
+    def __init__(self, pctLow=0.65, pctHigh=1.75, samplesPerSecond=4,
+                 blackoutLeft=10, blackoutRight=10):
+        self.pctLow = pctLow
+        self.pctHigh = pctHigh
+        self.segLen = 60 * samplesPerSecond
+        self.blackoutLeft = blackoutLeft
+        self.blackoutRight = blackoutRight
+
+        self._raw = np.zeros(0)                 # samples awaiting artifact detection
+        self._nProcessed = 0                    # samples through artifact detection
+        self._reference = None                  # (first, second) once established
+        self._pendingClear = 0                  # artifact black-out extending into next chunk
+
+        self._artifactMask = np.zeros(0, dtype=bool)   # artifact mask awaiting dilation
+        self._artifactStart = 0                 # index of first sample in _artifactMask
+        self.nEmitted = 0
+
+    def push(self, chunk):
+        """Adds samples, returning mask for next block of finalized samples"""
+        self._raw = np.concatenate([self._raw, np.asarray(chunk, dtype=np.float64)])
+        self._detectArtifacts(final=False)
+        return self._dilate(final=False)
+
+    def finish(self):
+        """Returns mask for all remaining samples at end of recording"""
+        self._detectArtifacts(final=True)
+        return self._dilate(final=True)
+
+    def _consume(self, n, mask):
+        self._raw = self._raw[n:]
+        self._nProcessed += n
+        self._artifactMask = np.concatenate([self._artifactMask, mask])
+
+    def _establishReference(self, final):
+        """Mirrors initialReferenceFHR, returning False if more samples are needed"""
+        valid = self._raw > 0
+        if not np.any(valid):
+            self._consume(len(valid), valid)   # invalid samples need no reference
+            return False
+
+        nSkip = np.argmax(valid)
+        self._consume(nSkip, valid[:nSkip])
+        v = self._nProcessed                   # first valid sample
+        raw = self._raw
+
+        if v == 0 and len(raw) < 2:
+            if final:
+                self._consume(len(raw), raw > 0)
+            return False
+        if v == 0 and raw[1] > 0:
+            self._reference = (raw[0], raw[1])
+            return True
+
+        blockEnd = (v // self.segLen + 1) * self.segLen
+        if self._nProcessed + len(raw) < blockEnd and not final:
+            return False
+        seg = raw[:blockEnd - self._nProcessed]
+        medVal = np.median(seg[seg > 0])
+        first = raw[0] if v == 0 else medVal
+        second = raw[0] if v == 1 else medVal
+        self._reference = (first, second)
+        return True
+
+    def _detectArtifacts(self, final):
+        if self._reference is None and not self._establishReference(final):
+            return
+        if len(self._raw) == 0:
+            return
+
+        raw = self._raw
+        inputMask = raw > 0
+        outputMask = np.copy(inputMask)
+        outputMask[:self._pendingClear] = False
+
+        start = max(2 - self._nProcessed, 0)   # batch loop starts at third sample
+        first, second, beyond = runMaskBadFHRLoop(raw, inputMask, outputMask, start,
+                                                  self._reference[0], self._reference[1],
+                                                  self.pctLow, self.pctHigh)
+        self._reference = (first, second)
+        self._pendingClear = max(self._pendingClear - len(raw), beyond)
+        self._consume(len(raw), outputMask)
+
+    def _dilate(self, final):
+        total = self._artifactStart + len(self._artifactMask)
+        emitEnd = total if final else max(total - self.blackoutLeft, self.nEmitted)
+        if emitEnd == self.nEmitted:
+            return np.zeros(0, dtype=bool)
+
+        dilated = dilateMask(self._artifactMask, self.blackoutLeft, self.blackoutRight)
+        result = dilated[self.nEmitted - self._artifactStart:emitEnd - self._artifactStart]
+        self.nEmitted = emitEnd
+
+        # retain history still able to black-out samples not yet emitted
+        keepFrom = max(self.nEmitted - max(self.blackoutRight - 1, 0), self._artifactStart)
+        self._artifactMask = self._artifactMask[keepFrom - self._artifactStart:]
+        self._artifactStart = keepFrom
+        return result
+
+
+class StreamingFilter(object):
+    """Stateful Butterworth filter for signal arriving in chunks, carrying filter state between
+       calls.
+
+       With delay=0 output is causal, and concatenated output matches
+       filterSignal(sig, useFiltFilt=False, ...) exactly.  With delay > 0 each emitted sample
+       has also been filtered backwards from at least delay samples ahead.  This approximates
+       zero-phase filtfilt output with bounded latency, with accuracy improving as delay
+       increases relative to filter time constant.
+
+       The backward pass covers all retained samples, costing O(delay + block), so output is
+       emitted in blocks of at least block samples (default delay), giving amortized cost
+       O((delay + block) / block) per sample and latency of delay to delay + block - 1 samples.
+       block=1 emits on every push at O(delay) per push.
+    """
+
+    def __init__(self, fType='lowpass', freq=0.025, order=4, fs_Hz=4.0, delay=0, block=None):
+        self.design = designFilter(fType=fType, freq=freq, order=order, fs_Hz=fs_Hz)
+        self.delay = delay
+        self.block = block if block is not None else max(delay, 1)
+        self._zi = None                  # forward filter state
+        self._forward = np.zeros(0)      # forward filtered samples not yet emitted
+        self.nEmitted = 0
+
+    def push(self, chunk):
+        """Adds samples, returning filtered output for next block of samples"""
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if len(chunk) == 0:
+            return np.zeros(0)
+        if self._zi is None:
+            self._zi = self.design['zi'] * chunk[0]
+        y, self._zi = signal.lfilter(self.design['b'], self.design['a'], chunk, zi=self._zi)
+
+        if self.delay == 0:
+            self.nEmitted += len(y)
+            return y
+        self._forward = np.concatenate([self._forward, y])
+        if len(self._forward) - self.delay < self.block:
+            return np.zeros(0)
+        return self._emit(len(self._forward) - self.delay)
+
+    def finish(self):
+        """Returns output for all remaining samples at end of recording"""
+        return self._emit(len(self._forward))
+
+    def _emit(self, nEmit):
+        if nEmit <= 0:
+            return np.zeros(0)
+        reverse = self._forward[::-1]
+        y, _ = signal.lfilter(self.design['b'], self.design['a'], reverse,
+                              zi=self.design['zi'] * reverse[0])
+        result = y[::-1][:nEmit]
+        self._forward = self._forward[nEmit:]
+        self.nEmitted += nEmit
+        return result
+
+
+class StreamingFilterBank(object):
+    """Streaming equivalent of filterBands, returning (len(freqs), n) array for each chunk"""
+
+    def __init__(self, freqs, fType='lowpass', order=4, fs_Hz=4.0, delay=0, block=None):
+        self.allFilters = [StreamingFilter(fType=fType, freq=freq, order=order, fs_Hz=fs_Hz,
+                                           delay=delay, block=block)
+                           for freq in freqs]
+
+    def push(self, chunk):
+        return np.vstack([filt.push(chunk) for filt in self.allFilters])
+
+    def finish(self):
+        return np.vstack([filt.finish() for filt in self.allFilters])
+
+
+def streamingFilterUC(freqLow=0.025, filt_order=4, fs_Hz=4.0, delay=0, block=None):
+    """Streaming equivalent of filterUC"""
+    return StreamingFilter(fType='lowpass', freq=freqLow, order=filt_order, fs_Hz=fs_Hz,
+                           delay=delay, block=block)
+
+
+class StreamingBaseline(object):
+    """Online equivalent of altComputeBaseline.  push() appends samples, evaluating each segment
+       once when its final sample has arrived, so appending one minute costs O(segment) regardless
+       of recording length.  Only samples of the next pending segment are retained.
+
+       Stable segments are available at any time from includePoints.  getBaseline() matches
+       altComputeBaseline over all samples pushed so far.
+    """
+
+    def __init__(self, segmentSizeInMin=4, samplesPerMin=60 * 4, pctValid=0.5,
+                 percentile=70, thresh=10, stepSize=None):
+        self.perSeg = segmentSizeInMin * samplesPerMin
+        self.stepSize = samplesPerMin if stepSize is None else stepSize
+        self.minCount = pctValid * self.perSeg
+        self.percentile = percentile
+        self.thresh = thresh
+
+        self._sig = np.zeros(0)
+        self._mask = np.zeros(0, dtype=bool)
+        self._start = 0                  # index of first retained sample
+        self._nextEnd = self.perSeg      # end of next segment to evaluate
+        self.n = 0
+
+        self.allMedians = []             # (idx, median, mad, percentile deviation)
+        self.includePoints = []          # stable segments: {'idx': idx, 'val': median}
+
+    def push(self, estHR, mask):
+        """Adds samples, returning list of newly identified stable segments"""
+        self._sig = np.concatenate([self._sig, np.asarray(estHR, dtype=np.float64)])
+        self._mask = np.concatenate([self._mask, np.asarray(mask) != 0])
+        self.n += len(estHR)
+
+        newPoints = []
+        while self._nextEnd < self.n:    # altComputeBaseline evaluates segments ending before n
+            i = self._nextEnd - self._start
+            segMask = self._mask[i - self.perSeg:i]
+            if np.sum(segMask) > self.minCount:
+                seg = self._sig[i - self.perSeg:i][segMask]
+                med = np.median(seg)
+                dev = np.abs(seg - med)
+                entry = (self._nextEnd, med, np.median(dev), np.percentile(dev, self.percentile))
+                self.allMedians.append(entry)
+                if entry[3] < self.thresh:
+                    newPoints.append({'idx': entry[0], 'val': entry[1]})
+            self._nextEnd += self.stepSize
+
+        keepFrom = max(self._nextEnd - self.perSeg, self._start)
+        self._sig = self._sig[keepFrom - self._start:]
+        self._mask = self._mask[keepFrom - self._start:]
+        self._start = keepFrom
+
+        self.includePoints.extend(newPoints)
+        return newPoints
+
+    @property
+    def currentBaseline(self):
+        """Baseline at most recent sample, None before first segment evaluated"""
+        if self.includePoints:
+            return self.includePoints[-1]['val']
+        if self.allMedians:
+            return np.median([x[1] for x in self.allMedians])
+        return None
+
+    def getBaseline(self, indices=None):
+        """Baseline at indices (defaults to all samples pushed so far)"""
+        if indices is None:
+            indices = np.arange(self.n)
+        if self.includePoints:
+            return np.interp(indices, [x['idx'] for x in self.includePoints],
+                             [x['val'] for x in self.includePoints])
+        return np.ones(len(indices)) * np.median([x[1] for x in self.allMedians])
+
+
+class StreamingInterpolator(object):
+    """Streaming equivalent of interpolateHR(useLinear=True).  Samples within a gap are returned
+       once the next valid sample arrives, retaining only the last valid sample and gap start.
+       Any trailing gap is filled with the last valid value by finish()."""
+
+    def __init__(self, fs=4.0):
+        self.fs = float(fs)
+        self._last = None        # (index, value) of last valid sample
+        self._pending = 0        # index of first sample not yet returned
+        self.n = 0
+
+    def _ts(self, idx):
+        return np.asarray(idx, dtype=np.float64) / self.fs / 60.0
+
+    def push(self, sig, mask):
+        start = self.n
+        self.n += len(sig)
+        validIdx = np.flatnonzero(mask)
+        if len(validIdx) == 0:
+            return np.zeros(0)
+
+        xp = start + validIdx
+        fp = np.asarray(sig, dtype=np.float64)[validIdx]
+        if self._last is not None:
+            xp = np.concatenate([[self._last[0]], xp])
+            fp = np.concatenate([[self._last[1]], fp])
+
+        result = np.interp(self._ts(np.arange(self._pending, xp[-1] + 1)), self._ts(xp), fp)
+        self._last = (xp[-1], fp[-1])
+        self._pending = xp[-1] + 1
+        return result
+
+    def finish(self):
+        fill = self._last[1] if self._last is not None else np.nan
+        result = np.ones(self.n - self._pending) * fill
+        self._pending = self.n
+        return result
+
+
+class _SampleQueue(object):
+    """FIFO of samples, used to align outputs of stages having differing latencies"""
+
+    def __init__(self):
+        self._chunks = []
+        self.n = 0
+
+    def append(self, chunk):
+        if chunk.shape[-1] > 0:
+            self._chunks.append(chunk)
+            self.n += chunk.shape[-1]
+
+    def pop(self, n):
+        allSamples = np.concatenate(self._chunks, axis=-1) if self._chunks else np.zeros(0)
+        self._chunks = [allSamples[..., n:]] if allSamples.shape[-1] > n else []
+        self.n -= n
+        return allSamples[..., :n]
+
+
+class StreamingCTGPipeline(object):
+    """Streaming version of processRecordingCTG stages: mask, dilate, interpolate, baseline, clip,
+       smooth x3 and filter UC.  push(rawFHR, rawUC) returns dict of outputs for those samples
+       finalized by every stage, with memory bounded by stage latencies rather than recording length.
+
+       Outputs match processRecordingCTG for mask and estHR prior to clipping.  Other stages are
+       necessarily causal approximations:
+       - baseline holds most recent stable segment median, NaN before first stable segment
+       - estHR is clipped at running minimum of valid FHR rather than minimum of entire recording
+       - smoothing and UC filter use look-ahead of at least delay samples in place of filtfilt,
+         emitted in blocks of block samples (default delay), so outputs lag input by up to
+         delay + block samples (8 minutes by default)
+    """
+
+    def __init__(self, freqLow=0.0125 / 2, freqHigh=0.0125, freqHigh2=0.0125 * 2,
+                 blackoutLeft=10, blackoutRight=10, fs=4, delay=4 * 60 * 4, maxHR=200, block=None):
+        self.fs = fs
+        self.maxHR = maxHR
+        self.masker = StreamingFHRMasker(samplesPerSecond=fs,
+                                         blackoutLeft=blackoutLeft, blackoutRight=blackoutRight)
+        self.interpolator = StreamingInterpolator(fs=fs)
+        self.baseline = StreamingBaseline(samplesPerMin=60 * fs)
+        self.smoothers = StreamingFilterBank([freqLow, freqHigh, freqHigh2], order=4, fs_Hz=fs,
+                                             delay=delay, block=block)
+        self.ucFilter = streamingFilterUC(freqLow=0.025, filt_order=4, fs_Hz=fs, delay=delay, block=block)
+
+        self._minVal = np.inf
+        self._baselineVal = np.nan
+        self.nEmitted = 0
+
+        self._awaitingMask = _SampleQueue()          # rawFHR awaiting mask
+        self._awaitingInterp = _SampleQueue()        # (rawFHR, mask) awaiting interpolation
+        self._queues = dict([(name, _SampleQueue())
+                             for name in ['rawFHR', 'mask', 'estHR', 'baseline', 'smooth', 'rawUC', 'filtUC']])
+
+    def push(self, rawFHR, rawUC):
+        rawFHR = np.asarray(rawFHR, dtype=np.float64)
+        self._awaitingMask.append(rawFHR)
+        self._processFHR(self.masker.push(rawFHR), final=False)
+        self._queues['rawUC'].append(np.asarray(rawUC, dtype=np.float64))
+        self._queues['filtUC'].append(self.ucFilter.push(rawUC))
+        return self._emit()
+
+    def finish(self):
+        self._processFHR(self.masker.finish(), final=True)
+        self._queues['smooth'].append(self.smoothers.finish())
+        self._queues['filtUC'].append(self.ucFilter.finish())
+        return self._emit()
+
+    def _processFHR(self, mask, final):
+        raw = self._awaitingMask.pop(len(mask))
+        self._awaitingInterp.append(np.vstack([raw, mask]))
+        estHR = self.interpolator.push(raw, mask)
+        if final:
+            estHR = np.concatenate([estHR, self.interpolator.finish()])
+        if len(estHR) == 0:
+            return
+        raw, mask = self._awaitingInterp.pop(len(estHR))
+        mask = mask != 0
+
+        # causal baseline: most recent stable segment at or before each sample
+        start = self.baseline.n
+        newPoints = self.baseline.push(estHR, mask)
+        baseline = np.ones(len(estHR)) * self._baselineVal
+        for point in newPoints:
+            baseline[max(point['idx'] - start, 0):] = point['val']
+        if newPoints:
+            self._baselineVal = newPoints[-1]['val']
+
+        if np.any(mask):
+            self._minVal = min(self._minVal, np.min(raw[mask]))
+        clipped = np.minimum(np.maximum(estHR, self._minVal), self.maxHR)
+
+        self._queues['rawFHR'].append(raw)
+        self._queues['mask'].append(mask)
+        self._queues['estHR'].append(clipped)
+        self._queues['baseline'].append(baseline)
+        self._queues['smooth'].append(self.smoothers.push(clipped))
+
+    def _emit(self):
+        n = min([q.n for q in self._queues.values()])
+        result = dict([(name, q.pop(n)) for name, q in self._queues.items()])
+        smooth = result.pop('smooth')
+        if smooth.ndim < 2:
+            smooth = np.zeros((3, 0))
+        result['smoothLowHR'], result['smoothHighHR'], result['smoothHighHR2'] = smooth
+        result['mask'] = result['mask'] != 0
+        result['ts'] = np.arange(self.nEmitted, self.nEmitted + n) / float(self.fs) / 60.0
+        self.nEmitted += n
+        return result
+
+
+def streamProcessCTG(chunks, **kwargs):
+    """Generates outputs of StreamingCTGPipeline for each (rawFHR, rawUC) chunk, followed by
+       remaining samples at end of recording"""
+    pipeline = StreamingCTGPipeline(**kwargs)
+    for rawFHR, rawUC in chunks:
+        yield pipeline.push(rawFHR, rawUC)
+    yield pipeline.finish()
+
+
+def processRecordingStreamCTG(src, chunkSize=60 * 4, recordPrefix=BASE_ctu_uhb_ctgdb, **kwargs):
+    """Processes recording by draining StreamingCTGPipeline, returning same outputs as
+       processRecordingCTG (subject to streaming approximations noted in StreamingCTGPipeline)"""
+    record = getPhysionetRecord(src, recordPrefix)
+    rawFHR = record.rawFHR
+    rawUC = record.rawUC
+    chunks = [(rawFHR[i:i + chunkSize], rawUC[i:i + chunkSize]) for i in range(0, len(rawFHR), chunkSize)]
+
+    allOutputs = list(streamProcessCTG(chunks, fs=int(record.fs), **kwargs))
+    out = dict([(name, np.concatenate([x[name] for x in allOutputs])) for name in allOutputs[0].keys()])
+
+    history = summarizeHistory(record.comments)
+    artifacts = "\n".join(['Placeholder'])
+    return CTGResult(record.fs, out['rawFHR'], out['estHR'], out['mask'], out['baseline'], out['smoothLowHR'],
+                     out['rawUC'], out['smoothHighHR'], out['smoothHighHR2'], out['filtUC'],
+                     history=history, artifacts=artifacts)
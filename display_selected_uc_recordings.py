@@ -14,6 +14,7 @@ from libTocopatchSignal import ProcessUC, isolateUC, UC_DEFAULT_PARAMS
 from libTocopatchSignal import butter_bandpass_filter, butter_lowpass_filter
 from libTocopatchSignal import clipExtremeAC, clipMinDC
 from libFilterUC import filterArtfactsUC, removeSpikes, PARAMS_FILTER_UC
+from libRecordingStore import openRecording
 
 
 
@@ -85,8 +86,7 @@ def showAllContractions(selectedRecordings, path,
             fname = '{}/{}/{}.p'.format(path, key, v['uuid'])
             print '{}/{}.p'.format(key, v['uuid'])
             #print 'Comments:', data[key]['comment']
-            with open(fname, 'r') as f:
-                recording = pickle.load(f)
+            recording = openRecording(fname)
 
             if 'uc' not in recording or 'pos' not in recording['uc']:
                 print
@@ -9,31 +9,28 @@ import numpy as np
 from scipy import signal
 import traceback
 import sys
+from collections import deque
+from functools import partial
+from itertools import izip
 #from analyze_recordings import computeBaseline
 
 from libUltrasound import combineExtractionResults
 from libUC import findUC
+from libRecordingCatalog import openCatalog, RecordingCatalog
+from libRecordingStore import openRecording, recordingMtime
+from ctg_cache import stageKey
 
 def selectRecordings(path, selectedDate=None):
-    with open(path + '/patient_data.p', 'r') as f:
-        data = pickle.load(f)
+    """Returns uuids of patients with recordings modified since selectedDate, most recent first,
+       together with RecordingCatalog providing patient data and recordings for each patient"""
+    catalog = openCatalog(path)
 
     if selectedDate:
         tMin = int(datetime.date(*selectedDate).strftime("%s"))
     else:
         tMin = 0
 
-    subset_recordings = []
-    for patient_uuid in data.keys():
-        thisDir = path + '/' + patient_uuid
-        stats = os.stat(thisDir)
-        if stats.st_mtime < tMin:
-            continue
-
-        subset_recordings.append([stats.st_ctime, patient_uuid, ])
-
-    subset_recordings = [x[1] for x in sorted(subset_recordings, reverse=True)]
-    return subset_recordings, data
+    return catalog.selectPatients(tMin), catalog
 
 
 
@@ -59,70 +56,207 @@ def detectUC(data):
 
 
 
-def getRecordingsLowCostCTG(subset_recordings, data, path, min_duration_plot=10, includeSep=False, skip=0):
-    patient_no = 1
-    total_skipped = 0
-    for patient_uuid in subset_recordings:
-        patient = data[patient_uuid]
+PREPROCESS_FIELDS = ('estHR', 'mask', 'ts', 'allUC', 'sigUC', 'tsUC')
+PREPROCESS_VERSION = 1    # increment when preprocessing changes (eg: combineExtractionResults, detectUC, findUC)
 
-        thisDir = path + '/' + patient_uuid
-        with open(thisDir + '/recordings_data.p', 'r') as f:
-            recordings = pickle.load(f)
 
-        for r in recordings.values():
-            if r['duration'] < min_duration_plot:
-                continue
+def fillMaskedHR(sig, mask):
+    """Linear interpolation by sample index of samples where mask is False, in a single pass over
+       invalid samples only.  Valid samples are unchanged."""
+    validIdx = np.flatnonzero(mask)
+    fillIdx = np.flatnonzero(~mask)
+    estHR = np.array(sig, dtype=np.float64)
+    estHR[fillIdx] = np.interp(fillIdx, validIdx, estHR[validIdx])
+    return estHR
 
-            if skip > 0 and total_skipped < skip:
-                total_skipped += 1
-                patient_no += 1
-                continue
 
-            try:
-                with open(thisDir + '/' + r['uuid'] + '.p', 'r') as f:
-                    recording = pickle.load(f)
+def preprocessRecordingLowCostCTG(recording):
+    """Combines extracted HR and detects UC, returning (estHR, mask, ts, allUC, sigUC, tsUC)"""
+    pos = recording['pitch']['pos']
+    sigFinal, maskFinal = combineExtractionResults(recording['envelope']['hr'],
+                                                   recording['pitch']['hr'], showStats=False)
+    # ALign all array lengths, using views
+    N = min(len(sigFinal), len(pos), len(maskFinal))
+    sigFinal = sigFinal[:N]
+    maskFinal = maskFinal[:N]
+    ts = pos[:N] / 60.0
 
-            except Exception, e:
-                print 'Exception:', e
-                continue
+    estHR = fillMaskedHR(sigFinal, maskFinal)
 
-            if includeSep:
-                print
-                print '-' * 40
+    allUC = detectUC(recording)
 
-            print
-            print 'Patient:', patient_no
-            patient_no += 1
-            print 'Patient:  {}, {} -- {}'.format(
-                patient['last_name'], patient['first_name'], patient['uuid'])
-            print 'Comment:', patient['comment']
-            print
-            print 'Recording - Duration: {:0.0f}m   Date: {}  {}'.format(r['duration'], r['date'], r['uuid'])
-            print
+    if 'uc_source' not in recording or recording['uc_source'] is None:
+        return estHR, maskFinal, ts, allUC, None, None
+    else:
+        return estHR, maskFinal, ts, allUC, recording['uc']['uc'], recording['uc']['posMin']
 
-            ts = recording['pitch']['pos'] / 60.0
-            sigFinal, maskFinal = combineExtractionResults(recording['envelope']['hr'],
-                                                           recording['pitch']['hr'], showStats=False)
-            # ALign all array lengths
-            N = min(len(sigFinal), len(ts), len(maskFinal))
-            sigFinal = sigFinal[:N]
-            ts = ts[:N]
-            maskFinal = maskFinal[:N]
 
-            indices = np.arange(len(sigFinal))
-            estHR = np.interp(indices, indices[maskFinal], sigFinal[maskFinal])
+def _preprocessKeys(fname):
+    uuid = os.path.basename(fname)[:-len('.p')]
+    params = {'uuid': uuid, 'mtime': recordingMtime(fname), 'version': PREPROCESS_VERSION}
+    return dict((name, stageKey('preprocessLowCostCTG.' + name, params))
+                for name in PREPROCESS_FIELDS + ('hasUC',))
 
-            allUC = detectUC(recording)
 
-            if 'uc_source' not in recording or recording['uc_source'] is None:
-                yield estHR, maskFinal, ts, allUC, None, None, r['uuid']
-            else:
-                yield estHR, maskFinal, ts, allUC, recording['uc']['uc'], recording['uc']['posMin'], r['uuid']
+def _getCachedPreprocess(cache, keys):
+    hasUC = cache.get(keys['hasUC'])
+    if hasUC is None:
+        return None
+    result = []
+    for name in PREPROCESS_FIELDS if hasUC else PREPROCESS_FIELDS[:4]:
+        value = cache.get(keys[name])
+        if value is None:
+            return None
+        result.append(value)
+    result[3] = result[3].tolist()              # allUC
+    if not hasUC:
+        result.extend([None, None])
+    return tuple(result)
+
+
+def loadRecordingLowCostCTG(fname, cache=None):
+    """Loads recording and extracts FHR and UC, returning (estHR, mask, ts, allUC, sigUC, tsUC)
+       or None if recording cannot be loaded.  If cache (a ctg_cache.StageCache) is given, results
+       are reused for recording uuid until its source file is modified"""
+    if cache is not None:
+        keys = _preprocessKeys(fname)
+        result = _getCachedPreprocess(cache, keys)
+        if result is not None:
+            return result
+
+    try:
+        recording = openRecording(fname)
+
+    except Exception, e:
+        print 'Exception:', e
+        return None
+
+    result = preprocessRecordingLowCostCTG(recording)
+
+    if cache is not None:
+        hasUC = result[4] is not None
+        for name, value in zip(PREPROCESS_FIELDS if hasUC else PREPROCESS_FIELDS[:4], result):
+            cache.put(keys[name], np.asarray(value))
+        cache.put(keys['hasUC'], np.array(hasUC))   # written last, marking entry complete
+    return result
+
+
+def prefetchMap(func, allArgs, prefetch=4, maxBytes=None, allSizes=None, useProcesses=False):
+    """Generates func(arg) for each arg in order, evaluating up to prefetch calls ahead of consumer
+       using pool of threads (or processes).  If maxBytes given, calls ahead are also limited so
+       that sum of allSizes for pending results remains within maxBytes (allowing at least one).
+       Prefetching requires concurrent.futures (futures package under python 2)."""
+    if prefetch <= 0:
+        for arg in allArgs:
+            yield func(arg)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+    if allSizes is None:
+        allSizes = [0] * len(allArgs)
+    Executor = ProcessPoolExecutor if useProcesses else ThreadPoolExecutor
+    pending = deque()
+    pendingBytes = 0
+    with Executor(max_workers=prefetch) as executor:
+        try:
+            for arg, size in zip(allArgs, allSizes):
+                while pending and (len(pending) >= prefetch or
+                                   (maxBytes is not None and pendingBytes + size > maxBytes)):
+                    future, futureSize = pending.popleft()
+                    pendingBytes -= futureSize
+                    yield future.result()
+                pending.append((executor.submit(func, arg), size))
+                pendingBytes += size
 
-            if includeSep:
-                print
-                print '*' * 40
-                print
+            while pending:
+                yield pending.popleft()[0].result()
+        finally:
+            for future, _ in pending:    # consumer stopped early
+                future.cancel()
 
 
+def _fileSize(fname):
+    try:
+        return os.stat(fname).st_size
+    except OSError:
+        return 0
+
+
+def _recordingIndex(subset_recordings, data, path, min_duration_plot):
+    """(patient uuid, recording uuid, summary) for each recording of at least min_duration_plot,
+       where summary is None if it is to be read from catalog"""
+    if isinstance(data, RecordingCatalog):
+        return [(patient_uuid, uuid, None) for patient_uuid, uuid in
+                data.getRecordingIndex(subset_recordings, minDuration=min_duration_plot)]
+
+    index = []
+    for patient_uuid in subset_recordings:
+        with open(path + '/' + patient_uuid + '/recordings_data.p', 'r') as f:
+            recordings = pickle.load(f)
+        index.extend([(patient_uuid, r['uuid'], r) for r in recordings.values()
+                      if r['duration'] >= min_duration_plot])
+    return index
+
+
+def getRecordingsLowCostCTG(subset_recordings, data, path, min_duration_plot=10, includeSep=False, skip=0,
+                            limit=None, after=None, prefetch=0, prefetchBytes=None, useProcesses=False,
+                            cache=None):
+    """Generates (estHR, mask, ts, allUC, sigUC, tsUC, uuid) for each recording of selected patients.
+
+       Recordings may be paged using skip and limit (at most limit recordings are loaded), and a
+       session resumed by passing uuid of last recording consumed as after.  When data is a
+       RecordingCatalog, recordings preceding the requested page are not opened.
+
+       If prefetch > 0, up to prefetch recordings (and if given, at most prefetchBytes of recording
+       files) are loaded and preprocessed in background threads (or processes if useProcesses)
+       while current recording is consumed.  Recordings are generated in same order regardless.
+
+       If cache (a ctg_cache.StageCache) is given, preprocessed FHR and UC are reused for any
+       recording not modified since it was cached."""
+    index = _recordingIndex(subset_recordings, data, path, min_duration_plot)
 
+    start = skip
+    if after is not None:
+        allUuid = [uuid for _, uuid, _ in index]
+        if after not in allUuid:
+            raise Exception('Unknown recording for after: {}'.format(after))
+        start += allUuid.index(after) + 1
+    page = index[start:] if limit is None else index[start:start + limit]
+
+    patient_no = start + 1
+    selected = []
+    for patient_uuid, uuid, r in page:
+        if r is None:
+            r = data.getRecording(patient_uuid, uuid)
+        selected.append((data[patient_uuid], r, path + '/' + patient_uuid + '/' + uuid + '.p'))
+
+    allFname = [fname for _, _, fname in selected]
+    allSizes = [_fileSize(fname) for fname in allFname] if prefetchBytes is not None else None
+    allLoaded = prefetchMap(partial(loadRecordingLowCostCTG, cache=cache), allFname, prefetch=prefetch,
+                            maxBytes=prefetchBytes, allSizes=allSizes, useProcesses=useProcesses)
+
+    for (patient, r, _), loaded in izip(selected, allLoaded):
+        if loaded is None:
+            continue
+
+        if includeSep:
+            print
+            print '-' * 40
+
+        print
+        print 'Patient:', patient_no
+        patient_no += 1
+        print 'Patient:  {}, {} -- {}'.format(
+            patient['last_name'], patient['first_name'], patient['uuid'])
+        print 'Comment:', patient['comment']
+        print
+        print 'Recording - Duration: {:0.0f}m   Date: {}  {}'.format(r['duration'], r['date'], r['uuid'])
+        print
+
+        yield loaded + (r['uuid'],)
+
+        if includeSep:
+            print
+            print '*' * 40
+            print
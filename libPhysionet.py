@@ -5,50 +5,54 @@ from scipy import signal
 import math
 
 
-import wfdb
+import os
+import pickle
 from os import listdir
 from os.path import isfile, join
 
 import ctg_processing
+from ctg_record import getPhysionetRecord, parseToken, readPhysionetHeader, parseHeaderComments
 
 #BASE_ctu_uhb_ctgdb = '/Volumes/Recordings/physionet/ctu-uhb-ctgdb'
 BASE_ctu_uhb_ctgdb = '/Users/doug/Documents/ctg_recordings'
 
+METADATA_INDEX_FILE = 'metadata_index.p'
+
+_metadataIndexCache = {}
+_metadataTableCache = {}
+
+_QUERY_OPS = {'<': np.less, '<=': np.less_equal,
+              '>': np.greater, '>=': np.greater_equal,
+              '==': np.equal, '!=': np.not_equal}
+
 
 def downsample(sig, mask, ts, factor=4):
+    """Downsamples signal and mask by integer factor along last axis, where sig may stack several
+       channels and/or recordings of equal length (eg: FHR and UC) sharing timescale ts.  All rows
+       are decimated in a single call, so anti-alias filter is designed once.  Downsampled mask is
+       True where more than half of the corresponding samples are valid."""
+    sig = np.asarray(sig)
+    mask = np.asarray(mask)
     # downsamle signal and timescale
-    sigD = signal.decimate(sig, factor, zero_phase=True)
-    tsD = ts[::factor]
+    sigD = signal.decimate(sig, factor, zero_phase=True, axis=-1)
     # align lengths
-    #N = min(len(sigD), len(tsD))
-    N = min(len(sigD), len(tsD), len(sig)//factor, len(ts)//factor)
-    sigD = sigD[:N]
-    tsD = tsD[:N]
+    N = min(sigD.shape[-1], len(ts) // factor, sig.shape[-1] // factor)
+    sigD = sigD[..., :N]
+    tsD = ts[:N * factor:factor]
 
     # compute mask
-
-
-    maskD = np.sum(mask[:N * 4].reshape((N, 4)), axis=1) > factor / 2.0
+    maskD = np.sum(mask[..., :N * factor].reshape(mask.shape[:-1] + (N, factor)), axis=-1) > factor / 2.0
 
     return sigD, maskD, tsD
 
 
 def loadPhysionetRecording(src, blackoutLeft=10, blackoutRight=10, mask_method='basic',
                            recordPrefix=BASE_ctu_uhb_ctgdb):
-    recordName = recordPrefix + '/' + src
-    # ctgRecord = wfdb.rdsamp(fname)
-    sig, fields = wfdb.srdsamp(recordName)
-
-    # print sig.shape
-    fs = fields['fs']
-    signames = fields['signame']
-    units = fields['units']
-    comments = fields['comments']
-    # pprint(fields)
+    record = getPhysionetRecord(src, recordPrefix)
 
-    ts = np.arange(sig.shape[0]) / float(fs) / 60.0
-    rawFHR = sig[:, 0]
-    rawUC = sig[:, 1]
+    ts = record.ts
+    rawFHR = record.rawFHR
+    rawUC = record.rawUC
 
     if mask_method == 'basic':
         mask = rawFHR > 0
@@ -58,85 +62,176 @@ def loadPhysionetRecording(src, blackoutLeft=10, blackoutRight=10, mask_method='
 
     fhr = np.interp(ts, ts[mask], rawFHR[mask])
 
-    fhrD, maskD, tsD = downsample(fhr, mask, ts, factor=4)
-
-    ucD, _, _ = downsample(rawUC, rawUC > 0, ts, factor=4)
+    allSigD, allMaskD, tsD = downsample(np.vstack([fhr, rawUC]), np.vstack([mask, rawUC > 0]), ts, factor=4)
+    fhrD, ucD = allSigD
+    maskD = allMaskD[0]
 
     filtUC = ctg_processing.filterUC(ucD, freqLow=0.025, filt_order=4, fs_Hz=1.0)
 
     return fhrD, maskD, tsD, ucD, filtUC
 
 
-def parseToken(tok):
-    try:
-        return int(tok)
-    except Exception:
-        try:
-            return float(tok)
-        except Exception:
-            return tok
-
-
 def loadPhysionetMetadata(src, recordPrefix=BASE_ctu_uhb_ctgdb,
                           selectedFields=['pH', 'BDecf', 'pCO2', 'BE', 'Apgar1', 'Apgar5']):
-    recordName = recordPrefix + '/' + src
-    # ctgRecord = wfdb.rdsamp(fname)
-    sig, fields = wfdb.srdsamp(recordName)
+    allMeta = getPhysionetRecord(src, recordPrefix).meta
 
     meta = {}
-    for entry in fields['comments']:
-        tokens = entry.split()
-        if tokens[0] in selectedFields:
-            meta[tokens[0]] = parseToken(tokens[1])
+    for field in selectedFields:
+        if field in allMeta:
+            meta[field] = allMeta[field]
     return meta
 
 
+def loadMetadataIndex(mypath=BASE_ctu_uhb_ctgdb, indexFile=None):
+    """Returns {recno: meta} for all header fields of all recordings
+
+    Index is persisted in indexFile (defaults to metadata_index.p within database directory),
+    only re-parsing headers whose .hea mtime has changed since index was last saved.
+    """
+    if indexFile is None:
+        indexFile = join(mypath, METADATA_INDEX_FILE)
+
+    if indexFile in _metadataIndexCache:
+        index = _metadataIndexCache[indexFile]
+    elif isfile(indexFile):
+        try:
+            with open(indexFile, 'rb') as f:
+                index = pickle.load(f)
+        except Exception, e:
+            print 'loadMetadataIndex: ignoring unreadable index', indexFile, e
+            index = {}
+    else:
+        index = {}
+
+    allRecno = getAllRecordingNumbers(mypath)
+    updated = False
+    for recno in allRecno:
+        mtime = os.stat(join(mypath, recno + '.hea')).st_mtime
+        if recno not in index or index[recno]['mtime'] != mtime:
+            comments = readPhysionetHeader(join(mypath, recno))
+            index[recno] = {'mtime': mtime, 'meta': parseHeaderComments(comments)}
+            updated = True
+
+    for recno in set(index.keys()) - set(allRecno):
+        del index[recno]
+        updated = True
+
+    if updated:
+        _metadataTableCache.pop(indexFile, None)
+        try:
+            with open(indexFile + '.tmp', 'wb') as f:
+                pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(indexFile + '.tmp', indexFile)
+        except (IOError, OSError), e:
+            print 'loadMetadataIndex: unable to save index', indexFile, e
+    _metadataIndexCache[indexFile] = index
+
+    return dict([(recno, entry['meta']) for recno, entry in index.items()])
+
+
 def getAllRecordingNumbers(mypath=BASE_ctu_uhb_ctgdb):
     allRecno = sorted([f.split('.')[0] for f in listdir(mypath) if f.endswith('.hea')])
     return allRecno
 
 
+def buildMetadataTable(allMeta):
+    """Converts {recno: meta} into structured array with one row per recording, sorted by recno
+
+    Numeric fields are stored as float64 columns (missing values as NaN), any field containing
+    non-numeric values is stored as an object column.
+    """
+    allRecno = sorted(allMeta.keys())
+    allFields = sorted(set([field for meta in allMeta.values() for field in meta.keys()]))
+
+    columns = [np.array(allRecno, dtype='S{}'.format(max([len(x) for x in allRecno] + [1])))]
+    dtype = [('recno', columns[0].dtype)]
+    for field in allFields:
+        values = [allMeta[recno].get(field, np.nan) for recno in allRecno]
+        if all([isinstance(v, (int, long, float)) for v in values]):
+            columns.append(np.array(values, dtype=np.float64))
+        else:
+            columns.append(np.array(values, dtype=object))
+        dtype.append((field, columns[-1].dtype))
+
+    table = np.empty(len(allRecno), dtype=dtype)
+    for (field, _), col in zip(dtype, columns):
+        table[field] = col
+    return table
+
+
+def getMetadataTable(mypath=BASE_ctu_uhb_ctgdb, indexFile=None):
+    """Returns columnar metadata table, rebuilt only when metadata index changes"""
+    if indexFile is None:
+        indexFile = join(mypath, METADATA_INDEX_FILE)
+    allMeta = loadMetadataIndex(mypath, indexFile=indexFile)
+    if indexFile not in _metadataTableCache:
+        _metadataTableCache[indexFile] = buildMetadataTable(allMeta)
+    return _metadataTableCache[indexFile], allMeta
+
+
+def _isnan(col):
+    if col.dtype == object:
+        return np.array([isinstance(v, float) and math.isnan(v) for v in col], dtype=bool)
+    return np.isnan(col)
+
+
+def queryMetadataTable(table, predicates):
+    """Returns boolean selection for rows of metadata table satisfying all predicates
+
+    Each predicate is a tuple of (field, op) or (field, op, value), where op is one of
+    '<', '<=', '>', '>=', '==', '!=', 'in', 'isnan' or 'notnan'.  Comparisons against NaN
+    are always false.
+    """
+    selected = np.ones(len(table), dtype=bool)
+    for pred in predicates:
+        field, op = pred[0], pred[1]
+        if field not in table.dtype.names:
+            raise Exception('Unknown metadata field: {}'.format(field))
+        col = table[field]
+        if op == 'isnan':
+            selected &= _isnan(col)
+        elif op == 'notnan':
+            selected &= ~_isnan(col)
+        elif op == 'in':
+            selected &= np.in1d(col, pred[2])
+        elif op in _QUERY_OPS:
+            with np.errstate(invalid='ignore'):
+                selected &= _QUERY_OPS[op](col, pred[2])
+        else:
+            raise Exception('Invalid query operator: {}'.format(op))
+    return selected
+
+
+def queryRecordings(predicates=None, mypath=BASE_ctu_uhb_ctgdb, maxRecordings=None, indexFile=None):
+    """Generates (recno, meta) for recordings satisfying all predicates, in recno order"""
+    table, allMeta = getMetadataTable(mypath, indexFile=indexFile)
+    selected = table['recno'][queryMetadataTable(table, predicates or [])]
+    if maxRecordings:
+        selected = selected[:maxRecordings]
+
+    for recno in selected.tolist():
+        yield recno, allMeta[recno]
+
+
 def getSelectedRecordings(mypath=BASE_ctu_uhb_ctgdb,
                           max_BDecf=None, min_BDecf=None,
                           max_BE=None, min_BE=None,
                           max_pH=None, min_pH=None,
                           max_Apgar1=None, min_Apgar1=None,
                           max_Apgar5=None, min_Apgar5=None,
-                          maxRecordings=None):
-    allRecno = getAllRecordingNumbers(mypath)
-
-    count = 0
-    for recno in allRecno:
-        if maxRecordings and count == maxRecordings:
-            return
-        meta = loadPhysionetMetadata(recno, recordPrefix=mypath)
-        if math.isnan(meta['BDecf']) and (max_BDecf or min_BDecf):
-            continue
-        elif max_BDecf and meta['BDecf'] > max_BDecf or min_BDecf and meta['BDecf'] < min_BDecf:
-            continue
-
-        if math.isnan(meta['BE']) and (max_BE or min_BE):
-            continue
-        elif max_BE and meta['BE'] > max_BE or min_BE and meta['BE'] < min_BE:
-            continue
-
-        if math.isnan(meta['pH']) and (max_pH or min_pH):
-            continue
-        elif max_pH and meta['pH'] > max_pH or min_pH and meta['pH'] < min_pH:
-            continue
-
-        if math.isnan(meta['Apgar1']) and (max_Apgar1 or min_Apgar1):
-            continue
-        elif max_Apgar1 and meta['Apgar1'] > max_Apgar1 or min_Apgar1 and meta['Apgar1'] < min_Apgar1:
-            continue
-
-        if math.isnan(meta['Apgar5']) and (max_Apgar5 or min_Apgar5):
-            continue
-        elif max_Apgar5 and meta['Apgar5'] > max_Apgar5 or min_Apgar5 and meta['Apgar5'] < min_Apgar5:
-            continue
-
-        count += 1
-        yield recno, meta
+                          maxRecordings=None, indexFile=None):
+    predicates = []
+    for field, maxVal, minVal in [('BDecf', max_BDecf, min_BDecf),
+                                  ('BE', max_BE, min_BE),
+                                  ('pH', max_pH, min_pH),
+                                  ('Apgar1', max_Apgar1, min_Apgar1),
+                                  ('Apgar5', max_Apgar5, min_Apgar5)]:
+        if maxVal:
+            predicates.append((field, '<=', maxVal))
+        if minVal:
+            predicates.append((field, '>=', minVal))
+
+    return queryRecordings(predicates, mypath=mypath, maxRecordings=maxRecordings, indexFile=indexFile)
 
 
 def showMetadata(recno, meta):
@@ -0,0 +1,234 @@
+# coding: utf-8
+#
+#  Persistent catalog of low-cost CTG patients and recordings, stored as SQLite database
+#  alongside patient_data.p.  Refreshed incrementally: patient_data.p is only re-read when
+#  modified, and recordings_data.p only for patients whose directory has changed.
+#
+
+import os
+import pickle
+import sqlite3
+from os.path import join
+
+from libRecordingStore import openRecording, recordingMtime
+
+
+CATALOG_FILE = 'recording_catalog.db'
+CATALOG_VERSION = 2                  # catalog is rebuilt if created by a different version
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS patients (
+    uuid TEXT PRIMARY KEY, mtime REAL, ctime REAL, recordings_mtime REAL, data BLOB);
+CREATE TABLE IF NOT EXISTS recordings (
+    patient TEXT, uuid TEXT, seq INTEGER, duration REAL, mtime REAL,
+    has_uc_source INTEGER, uc_checked INTEGER, data BLOB,
+    PRIMARY KEY (patient, uuid));
+CREATE INDEX IF NOT EXISTS patients_mtime ON patients (mtime);
+CREATE INDEX IF NOT EXISTS recordings_duration ON recordings (duration);
+"""
+
+
+def _mtime(fname):
+    try:
+        return os.stat(fname).st_mtime
+    except OSError:
+        return None
+
+
+def _dumps(obj):
+    return sqlite3.Binary(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+
+def _loads(blob):
+    return pickle.loads(str(blob))
+
+
+def hasSourceUC(recording):
+    return 'uc_source' in recording and recording['uc_source'] is not None
+
+
+class RecordingCatalog(object):
+    """Catalog of patients and recordings under path.  Behaves as read-only dict of patient
+       data (as loaded from patient_data.p), with indexed queries for patients and recordings"""
+
+    def __init__(self, path, dbFile=None):
+        self.path = path
+        self.dbFile = dbFile if dbFile else join(path, CATALOG_FILE)
+        self.conn = sqlite3.connect(self.dbFile)
+        self.conn.executescript(_SCHEMA)
+        if self._getInfo('version') != CATALOG_VERSION:
+            with self.conn:
+                self.conn.executescript('DROP TABLE info; DROP TABLE patients; DROP TABLE recordings;')
+                self.conn.executescript(_SCHEMA)
+                self.conn.execute('INSERT INTO info VALUES (?, ?)', ('version', CATALOG_VERSION))
+        self._patients = {}      # unpickled patient data
+
+    def close(self):
+        self.conn.close()
+
+    def _getInfo(self, key):
+        row = self.conn.execute('SELECT value FROM info WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def refresh(self):
+        """Updates catalog for any changes to patient_data.p, patient directories or recordings"""
+        with self.conn:
+            self._refreshPatients()
+            allPatients = self.conn.execute(
+                'SELECT uuid, mtime, recordings_mtime FROM patients').fetchall()
+            for uuid, mtime, recordingsMtime in allPatients:
+                thisDir = join(self.path, uuid)
+                newMtime = _mtime(thisDir)
+                newRecordingsMtime = _mtime(join(thisDir, 'recordings_data.p'))
+                if newMtime != mtime or newRecordingsMtime != recordingsMtime:
+                    self._refreshRecordings(uuid, newMtime, newRecordingsMtime)
+
+    def _refreshPatients(self):
+        fname = join(self.path, 'patient_data.p')
+        mtime = _mtime(fname)
+        if mtime == self._getInfo('patient_data_mtime'):
+            return
+
+        with open(fname, 'r') as f:
+            data = pickle.load(f)
+
+        known = set(row[0] for row in self.conn.execute('SELECT uuid FROM patients'))
+        for uuid in known - set(data.keys()):
+            self.conn.execute('DELETE FROM patients WHERE uuid = ?', (uuid,))
+            self.conn.execute('DELETE FROM recordings WHERE patient = ?', (uuid,))
+        for uuid, patient in data.items():
+            if uuid in known:
+                self.conn.execute('UPDATE patients SET data = ? WHERE uuid = ?', (_dumps(patient), uuid))
+            else:
+                self.conn.execute('INSERT INTO patients (uuid, data) VALUES (?, ?)', (uuid, _dumps(patient)))
+        self.conn.execute('INSERT OR REPLACE INTO info VALUES (?, ?)', ('patient_data_mtime', mtime))
+        self._patients = {}
+
+    def _refreshRecordings(self, patientUuid, mtime, recordingsMtime):
+        thisDir = join(self.path, patientUuid)
+        ctime = os.stat(thisDir).st_ctime if mtime is not None else None
+        self.conn.execute('UPDATE patients SET mtime = ?, ctime = ?, recordings_mtime = ? WHERE uuid = ?',
+                          (mtime, ctime, recordingsMtime, patientUuid))
+
+        # retain has_uc_source for unchanged recordings, since it requires loading the recording
+        previous = dict((row[0], row[1:]) for row in self.conn.execute(
+            'SELECT uuid, mtime, has_uc_source, uc_checked FROM recordings WHERE patient = ?', (patientUuid,)))
+        self.conn.execute('DELETE FROM recordings WHERE patient = ?', (patientUuid,))
+        if recordingsMtime is None:
+            return
+
+        with open(join(thisDir, 'recordings_data.p'), 'r') as f:
+            recordings = pickle.load(f)
+
+        for seq, r in enumerate(recordings.values()):
+            fname = join(thisDir, r['uuid'] + '.p')
+            recMtime = recordingMtime(fname)
+            if 'uc_source' in r:
+                hasUC, checked = hasSourceUC(r), 1
+            elif r['uuid'] in previous and previous[r['uuid']][0] == recMtime:
+                hasUC, checked = previous[r['uuid']][1:]
+            else:
+                hasUC, checked = None, 0       # determined on demand by _resolveHasUC
+            self.conn.execute('INSERT INTO recordings VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (patientUuid, r['uuid'], seq, r['duration'], recMtime, hasUC, checked, _dumps(r)))
+
+    def _resolveHasUC(self, patientUuid=None, minDuration=None):
+        """Determines has_uc_source for unchecked recordings matching filters by loading each
+           recording once.  Unreadable recordings are reported and left as NULL"""
+        query = 'SELECT patient, uuid FROM recordings WHERE uc_checked = 0'
+        args = []
+        if patientUuid is not None:
+            query += ' AND patient = ?'
+            args.append(patientUuid)
+        if minDuration is not None:
+            query += ' AND duration >= ?'
+            args.append(minDuration)
+
+        with self.conn:
+            for patient, uuid in self.conn.execute(query, args).fetchall():
+                fname = join(self.path, patient, uuid + '.p')
+                try:
+                    hasUC = hasSourceUC(openRecording(fname))
+                except Exception, e:
+                    print 'RecordingCatalog: unable to read', fname, e
+                    hasUC = None
+                self.conn.execute('UPDATE recordings SET has_uc_source = ?, uc_checked = 1 '
+                                  'WHERE patient = ? AND uuid = ?', (hasUC, patient, uuid))
+
+    def selectPatients(self, tMin=0):
+        """Patients whose directory was modified since tMin, most recently created first"""
+        rows = self.conn.execute('SELECT uuid FROM patients WHERE mtime >= ? ORDER BY ctime DESC, uuid DESC',
+                                 (tMin,))
+        return [str(row[0]) for row in rows]
+
+    def getRecordings(self, patientUuid=None, minDuration=None, hasUC=None):
+        """Recording summaries (as stored in recordings_data.p), in original order for each patient"""
+        query = 'SELECT data FROM recordings WHERE 1'
+        args = []
+        if patientUuid is not None:
+            query += ' AND patient = ?'
+            args.append(patientUuid)
+        if minDuration is not None:
+            query += ' AND duration >= ?'
+            args.append(minDuration)
+        if hasUC is not None:
+            self._resolveHasUC(patientUuid, minDuration)
+            query += ' AND has_uc_source = ?'
+            args.append(1 if hasUC else 0)
+        query += ' ORDER BY patient, seq'
+        return [_loads(row[0]) for row in self.conn.execute(query, args)]
+
+    def getRecordingIndex(self, patientUuids, minDuration=None):
+        """(patient uuid, recording uuid) for each recording of patientUuids, in order of patientUuids
+           and then original order within each patient, without loading recording summaries"""
+        query = 'SELECT patient, uuid FROM recordings'
+        args = []
+        if minDuration is not None:
+            query += ' WHERE duration >= ?'
+            args.append(minDuration)
+        byPatient = {}
+        for patient, uuid in self.conn.execute(query + ' ORDER BY patient, seq', args):
+            byPatient.setdefault(patient, []).append((str(patient), str(uuid)))
+        return [entry for patientUuid in patientUuids for entry in byPatient.get(patientUuid, [])]
+
+    def getRecording(self, patientUuid, uuid):
+        """Recording summary (as stored in recordings_data.p)"""
+        row = self.conn.execute('SELECT data FROM recordings WHERE patient = ? AND uuid = ?',
+                                (patientUuid, uuid)).fetchone()
+        if row is None:
+            raise KeyError(uuid)
+        return _loads(row[0])
+
+    def __getitem__(self, patientUuid):
+        if patientUuid not in self._patients:
+            row = self.conn.execute('SELECT data FROM patients WHERE uuid = ?', (patientUuid,)).fetchone()
+            if row is None:
+                raise KeyError(patientUuid)
+            self._patients[patientUuid] = _loads(row[0])
+        return self._patients[patientUuid]
+
+    def __contains__(self, patientUuid):
+        return self.conn.execute('SELECT 1 FROM patients WHERE uuid = ?', (patientUuid,)).fetchone() is not None
+
+    def keys(self):
+        return [str(row[0]) for row in self.conn.execute('SELECT uuid FROM patients')]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+
+_catalogs = {}
+
+
+def openCatalog(path, dbFile=None, refresh=True):
+    """Returns catalog for path, reused within session, refreshing for any changes on disk"""
+    key = (path, dbFile)
+    if key not in _catalogs:
+        _catalogs[key] = RecordingCatalog(path, dbFile=dbFile)
+    if refresh:
+        _catalogs[key].refresh()
+    return _catalogs[key]
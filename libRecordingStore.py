@@ -0,0 +1,186 @@
+# coding: utf-8
+#
+#  Memory-mappable storage for low-cost CTG recordings.  Each <uuid>.p pickle of nested dicts
+#  is converted to directory <uuid>.arrays holding one .npy file per numeric array together with
+#  index.p for remaining (small) values.  Arrays are only read when accessed.
+#
+#  Usage:  python libRecordingStore.py <path to recordings> [--overwrite]
+#
+
+import os
+import pickle
+import shutil
+from os.path import join, isdir, isfile
+
+import numpy as np
+
+
+STORE_SUFFIX = '.arrays'
+INDEX_FILE = 'index.p'
+
+
+def storePath(fname):
+    """Store directory corresponding to recording pickle fname (eg: <patient>/<uuid>.p)"""
+    return (fname[:-2] if fname.endswith('.p') else fname) + STORE_SUFFIX
+
+
+def _mtime(fname):
+    try:
+        return os.stat(fname).st_mtime
+    except OSError:
+        return None
+
+
+def _flatten(value, prefix, arrays, values):
+    if isinstance(value, dict):
+        values[prefix] = {}            # marks nested dict, including if empty
+        for key, v in value.items():
+            _flatten(v, prefix + (key,), arrays, values)
+    elif type(value) is np.ndarray and value.dtype != object and value.size > 0:
+        arrays[prefix] = value
+    else:
+        values[prefix] = value
+
+
+def convertRecording(fname, overwrite=False):
+    """Converts recording pickle to store, returning store directory"""
+    dirname = storePath(fname)
+    srcMtime = _mtime(fname)
+    if isdir(dirname) and not overwrite and readIndex(dirname)['srcMtime'] == srcMtime:
+        return dirname
+
+    with open(fname, 'r') as f:
+        recording = pickle.load(f)
+
+    arrays = {}
+    values = {}
+    _flatten(recording, (), arrays, values)
+
+    tmpDir = dirname + '.{}.tmp'.format(os.getpid())
+    if isdir(tmpDir):
+        shutil.rmtree(tmpDir)
+    os.makedirs(tmpDir)
+    arrayFiles = {}
+    for i, (key, arr) in enumerate(arrays.items()):
+        arrayFiles[key] = 'a{}.npy'.format(i)
+        np.save(join(tmpDir, arrayFiles[key]), arr)
+    with open(join(tmpDir, INDEX_FILE), 'wb') as f:
+        pickle.dump({'srcMtime': srcMtime, 'arrays': arrayFiles, 'values': values}, f, pickle.HIGHEST_PROTOCOL)
+
+    if isdir(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmpDir, dirname)
+    return dirname
+
+
+def convertDatabase(path, overwrite=False, verbose=True):
+    """Converts all recording pickles within patient directories under path"""
+    for patient_uuid in sorted(os.listdir(path)):
+        thisDir = join(path, patient_uuid)
+        if not isdir(thisDir):
+            continue
+        for fname in sorted(os.listdir(thisDir)):
+            if not fname.endswith('.p') or fname == 'recordings_data.p':
+                continue
+            try:
+                convertRecording(join(thisDir, fname), overwrite=overwrite)
+            except Exception, e:
+                print 'convertDatabase: unable to convert', join(thisDir, fname), e
+                continue
+            if verbose:
+                print 'Converted:', join(patient_uuid, fname)
+
+
+def readIndex(dirname):
+    with open(join(dirname, INDEX_FILE), 'rb') as f:
+        return pickle.load(f)
+
+
+class LazyRecording(object):
+    """Read-only nested dict view of stored recording.  Arrays are memory-mapped copy-on-write
+       on first access, so callers may modify them without altering the store"""
+
+    def __init__(self, dirname, index=None, prefix=()):
+        self.dirname = dirname
+        self._index = index if index is not None else readIndex(dirname)
+        self._prefix = prefix
+        self._cache = {}
+
+    def _children(self):
+        n = len(self._prefix) + 1
+        return [key[-1] for key in list(self._index['arrays']) + list(self._index['values'])
+                if len(key) == n and key[:-1] == self._prefix]
+
+    def __getitem__(self, name):
+        if name in self._cache:
+            return self._cache[name]
+        key = self._prefix + (name,)
+        if key in self._index['arrays']:
+            value = np.load(join(self.dirname, self._index['arrays'][key]), mmap_mode='c')
+        elif key in self._index['values']:
+            value = self._index['values'][key]
+            if isinstance(value, dict):
+                value = LazyRecording(self.dirname, index=self._index, prefix=key)
+        else:
+            raise KeyError(name)
+        self._cache[name] = value
+        return value
+
+    def __contains__(self, name):
+        key = self._prefix + (name,)
+        return key in self._index['arrays'] or key in self._index['values']
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def keys(self):
+        return self._children()
+
+    def __iter__(self):
+        return iter(self._children())
+
+    def __len__(self):
+        return len(self._children())
+
+    def items(self):
+        return [(name, self[name]) for name in self._children()]
+
+    def values(self):
+        return [self[name] for name in self._children()]
+
+    def toDict(self):
+        """Fully loaded copy, equivalent to unpickled recording"""
+        result = {}
+        for name, value in self.items():
+            if isinstance(value, LazyRecording):
+                value = value.toDict()
+            elif isinstance(value, np.ndarray):
+                value = np.array(value)
+            result[name] = value
+        return result
+
+
+def openRecording(fname):
+    """Returns recording for pickle fname, as LazyRecording if converted store is present and up
+       to date (or pickle has since been removed), otherwise unpickled from fname"""
+    dirname = storePath(fname)
+    if isdir(dirname):
+        index = readIndex(dirname)
+        if not isfile(fname) or index['srcMtime'] == _mtime(fname):
+            return LazyRecording(dirname, index=index)
+
+    with open(fname, 'r') as f:
+        return pickle.load(f)
+
+
+def recordingMtime(fname):
+    """Modification time of recording, from store if pickle has been removed"""
+    mtime = _mtime(fname)
+    if mtime is None:
+        mtime = _mtime(join(storePath(fname), INDEX_FILE))
+    return mtime
+
+
+if __name__ == '__main__':
+    import sys
+    convertDatabase(sys.argv[1], overwrite='--overwrite' in sys.argv[2:])
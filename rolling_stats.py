@@ -0,0 +1,211 @@
+# coding: utf-8
+#
+#  Copyright Douglas Williams, 2017
+#  All Rights Reserved
+#
+#  Rolling statistics over masked signals, used when estimating FHR baseline
+#
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+MAX_WINDOW_ELEMENTS = 2 ** 20    # limits memory used when sorting batches of windows
+
+
+def windowStarts(n, window, step):
+    """Start index of each window, matching range(0, n - window, step)"""
+    return np.arange(0, max(n - window, 0), step)
+
+
+def _sortedWindows(vals, starts, window, step):
+    """Generates (first window number, sorted windows) in batches of up to MAX_WINDOW_ELEMENTS.
+       Invalid samples must already be replaced by +inf so they sort to end of each window"""
+    if len(starts) == 0:
+        return
+    if window % step == 0 and window >= step:
+        # windows are made up of whole blocks, so sort each block once and reuse in every
+        # window containing it.  Merging pre-sorted blocks is cheaper than sorting each window.
+        nBlocks = len(starts) - 1 + window // step
+        src = np.sort(vals[:nBlocks * step].reshape(nBlocks, step), axis=1).ravel()
+        kind = 'mergesort'
+    else:
+        src = vals
+        kind = 'quicksort'
+
+    batch = max(MAX_WINDOW_ELEMENTS // window, 1)
+    itemsize = src.strides[0]
+    for k in range(0, len(starts), batch):
+        nWin = min(batch, len(starts) - k)
+        win = as_strided(src[starts[k]:], shape=(nWin, window), strides=(step * itemsize, itemsize))
+        yield k, np.sort(win, axis=1, kind=kind)
+
+
+def sortedPercentile(sortedWin, counts, percentile):
+    """Percentile of first counts[j] values of each sorted row, using same linear
+       interpolation as np.percentile"""
+    index = (percentile / 100.0) * np.maximum(counts - 1, 0)
+    below = np.floor(index).astype(int)
+    above = np.minimum(below + 1, np.maximum(counts - 1, 0))
+    weightAbove = index - below
+    rows = np.arange(len(sortedWin))
+    with np.errstate(invalid='ignore'):   # rows without valid samples
+        return sortedWin[rows, below] * (1 - weightAbove) + sortedWin[rows, above] * weightAbove
+
+
+def rollingMaskedPercentile(sig, mask, window, step, percentile, minCount=0, quantum=0.25):
+    """Computes percentile of valid samples within windows sig[i:i + window] for
+       i in range(0, len(sig) - window, step), for all windows in a single vectorized pass
+
+    When all valid samples are multiples of quantum (eg: 0.25 bpm for CTU-UHB), percentiles are
+    taken from per-window histograms of quantized values, with cost O(len(sig) + windows * bins).
+    Otherwise windows are sorted.  Results are identical to np.percentile either way.
+
+    Returns:
+       valid - True for windows containing more than minCount valid samples
+       values - Percentile for each window, 0 if window not valid
+    """
+    starts = windowStarts(len(sig), window, step)
+    sig = np.asarray(sig, dtype=np.float64)
+    isValid = np.asarray(mask) != 0
+    cumValid = np.concatenate([[0], np.cumsum(isValid)])
+    counts = cumValid[starts + window] - cumValid[starts]
+
+    valid = counts > minCount
+    values = np.zeros(len(starts))
+
+    quantized = _quantizedBins(sig, isValid, quantum)
+    if quantized is None:
+        vals = np.where(isValid, sig, np.inf)
+        for k, sortedWin in _sortedWindows(vals, starts, window, step):
+            pct = sortedPercentile(sortedWin, counts[k:k + len(sortedWin)], percentile)
+            values[k:k + len(sortedWin)] = np.where(valid[k:k + len(sortedWin)], pct, 0)
+        return valid, values
+
+    binOf, qMin, nBins = quantized
+    allValid = np.flatnonzero(valid)
+    batch = max(MAX_WINDOW_ELEMENTS // nBins, 1)
+    for b in range(0, len(allValid), batch):
+        kk = allValid[b:b + batch]
+        cumHist = np.cumsum(_windowHistograms(binOf, starts[kk], window, nBins), axis=1)
+
+        # same interpolation between order statistics as sortedPercentile
+        index = (percentile / 100.0) * (counts[kk] - 1)
+        below = np.floor(index).astype(int)
+        above = np.minimum(below + 1, counts[kk] - 1)
+        weightAbove = index - below
+        valBelow = (qMin + _orderStat(cumHist, below)) * quantum
+        valAbove = (qMin + _orderStat(cumHist, above)) * quantum
+        values[kk] = valBelow * (1 - weightAbove) + valAbove * weightAbove
+
+    return valid, values
+
+
+def quantizeValues(vals, quantum):
+    """Returns vals as integer multiples of quantum, or None if vals not all on that grid"""
+    q = np.round(vals / quantum)
+    if not np.array_equal(q * quantum, vals):
+        return None
+    return q.astype(np.int64)
+
+
+def _quantizedBins(sig, isValid, quantum):
+    """Returns (binOf, qMin, nBins) where binOf is histogram bin of each valid sample (-1 if
+       invalid), or None if valid samples are not all multiples of quantum"""
+    bins = quantizeValues(sig[isValid], quantum) if quantum and np.any(isValid) else None
+    if bins is None:
+        return None
+    qMin = np.min(bins)
+    binOf = np.full(len(sig), -1, dtype=np.int64)
+    binOf[isValid] = bins - qMin
+    return binOf, qMin, np.max(bins) - qMin + 1
+
+
+def _windowHistograms(binOf, starts, window, nBins):
+    """Histogram of binOf[s:s + window] for each window start s, ignoring entries of -1.
+       Computed from cumulative histograms at window boundaries, so each sample counted once"""
+    boundaries = np.unique(np.concatenate([starts, starts + window]))
+    segBins = binOf[boundaries[0]:boundaries[-1]]
+    segIdx = np.searchsorted(boundaries, np.arange(boundaries[0], boundaries[-1]), side='right') - 1
+    use = segBins >= 0
+    hist = np.bincount(segIdx[use] * nBins + segBins[use],
+                       minlength=(len(boundaries) - 1) * nBins).reshape(len(boundaries) - 1, nBins)
+    cum = np.vstack([np.zeros((1, nBins), dtype=hist.dtype), np.cumsum(hist, axis=0)])
+    return (cum[np.searchsorted(boundaries, starts + window)] -
+            cum[np.searchsorted(boundaries, starts)])
+
+
+def _orderStat(cumCounts, rank):
+    """Index of first column of each row whose cumulative count exceeds rank"""
+    return np.sum(cumCounts <= rank[:, None], axis=1)
+
+
+def rollingMedianStats(sig, mask, window, step, percentile, minCount=0, quantum=0.25):
+    """For valid samples within windows sig[i:i + window], i in range(0, len(sig) - window, step),
+       computes median along with median and percentile of absolute deviation from median.
+
+    When all valid samples are multiples of quantum (eg: 0.25 bpm for CTU-UHB), statistics are
+    computed from per-window histograms of quantized values at a cost per window bounded by the
+    range of values rather than window size, so stepping by individual samples remains cheap.
+    Results are identical to np.median and np.percentile.  Otherwise each window is computed
+    individually.
+
+    Returns:
+       starts - Start index of each window
+       valid - True for windows containing more than minCount valid samples
+       med, mad, pctDev - Statistics for each window, 0 if window not valid
+    """
+    starts = windowStarts(len(sig), window, step)
+    sig = np.asarray(sig, dtype=np.float64)
+    isValid = np.asarray(mask) != 0
+    cumValid = np.concatenate([[0], np.cumsum(isValid)])
+    counts = cumValid[starts + window] - cumValid[starts]
+
+    valid = counts > minCount
+    med = np.zeros(len(starts))
+    mad = np.zeros(len(starts))
+    pctDev = np.zeros(len(starts))
+    allValid = np.flatnonzero(valid)
+
+    quantized = _quantizedBins(sig, isValid, quantum)
+    if quantized is None:
+        for k in allValid:
+            seg = sig[starts[k]:starts[k] + window][isValid[starts[k]:starts[k] + window]]
+            med[k] = np.median(seg)
+            dev = np.abs(seg - med[k])
+            mad[k] = np.median(dev)
+            pctDev[k] = np.percentile(dev, percentile)
+        return starts, valid, med, mad, pctDev
+
+    binOf, qMin, nBins = quantized
+
+    # deviations are expressed in units of quantum / 2, since median may fall between bins
+    devUnits = np.arange(2 * nBins)
+    batch = max(MAX_WINDOW_ELEMENTS // len(devUnits), 1)
+    for b in range(0, len(allValid), batch):
+        kk = allValid[b:b + batch]
+        hist = _windowHistograms(binOf, starts[kk], window, nBins)
+        cumHist = np.cumsum(hist, axis=1)
+        cumBelow = cumHist - hist
+        n = counts[kk]
+        rows = np.arange(len(kk))[:, None]
+
+        medUnits = _orderStat(cumHist, (n - 1) // 2) + _orderStat(cumHist, n // 2)
+
+        # number of samples within each deviation of median
+        hiBin = np.minimum((medUnits[:, None] + devUnits) // 2, nBins - 1)
+        loBin = np.maximum(-((devUnits - medUnits[:, None]) // 2), 0)
+        cumDev = cumHist[rows, hiBin] - cumBelow[rows, loBin]
+
+        index = (percentile / 100.0) * (n - 1)
+        below = np.floor(index).astype(int)
+        above = np.minimum(below + 1, n - 1)
+        weightAbove = index - below
+        devBelow = _orderStat(cumDev, below) * quantum / 2.0
+        devAbove = _orderStat(cumDev, above) * quantum / 2.0
+
+        med[kk] = (2 * qMin + medUnits) * quantum / 2.0
+        mad[kk] = (_orderStat(cumDev, (n - 1) // 2) + _orderStat(cumDev, n // 2)) * quantum / 4.0
+        pctDev[kk] = devBelow * (1 - weightAbove) + devAbove * weightAbove
+
+    return starts, valid, med, mad, pctDev